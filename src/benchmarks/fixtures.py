@@ -0,0 +1,153 @@
+import json
+import os
+import random
+
+from parser import finance_report
+from parser import period_sales
+from parser import utils
+
+
+def _period_stat(rnd: random.Random) -> dict:
+    orders = rnd.randint(0, 500)
+    return {
+        "openCount": rnd.randint(0, 20000),
+        "cartCount": rnd.randint(0, 3000),
+        "orderCount": orders,
+        "orderSum": round(orders * rnd.uniform(300, 5000), 2),
+        "buyoutCount": rnd.randint(0, orders),
+        "buyoutSum": round(rnd.uniform(0, 1_000_000), 2),
+        "cancelCount": rnd.randint(0, 50),
+        "cancelSum": round(rnd.uniform(0, 50_000), 2),
+        "avgPrice": round(rnd.uniform(300, 5000), 2),
+        "avgOrdersCountPerDay": round(rnd.uniform(0, 70), 2),
+        "localizationPercent": rnd.randint(0, 100),
+        "timeToReady": {"days": rnd.randint(0, 5), "hours": rnd.randint(0, 23), "mins": rnd.randint(0, 59)},
+        "wbClub": {"orderCount": rnd.randint(0, 50)},
+        "conversions": {"buyoutPercent": rnd.randint(0, 100)},
+    }
+
+
+def make_voronka_cards(count: int, seed: int = 1) -> list[dict]:
+    # Cards shaped like the sales-funnel/products response
+    rnd = random.Random(seed)
+    return [{
+        "product": {
+            "nmId": 100000 + i,
+            "title": f"Товар {i}",
+            "vendorCode": f"art-{i}",
+            "brandName": rnd.choice(["Brand A", "Brand B", "Brand C"]),
+            "subjectName": rnd.choice(["Футболки", "Платья", "Куртки"]),
+            "stocks": {"mp": rnd.randint(0, 100), "wb": rnd.randint(0, 1000)},
+        },
+        "statistic": {
+            "selected": _period_stat(rnd),
+            "past": _period_stat(rnd),
+        },
+    } for i in range(count)]
+
+
+_FIN_REPORT_TEXT_FIELDS = {
+    "subject_name": "Футболки", "brand_name": "Brand A", "ts_name": "M",
+    "doc_type_name": "Продажа", "supplier_oper_name": "Продажа", "payment_processing": "Эквайринг",
+    "fix_tariff_date_from": "", "fix_tariff_date_to": "", "bonus_type_name": "",
+    "sticker_id": "0", "acquiring_bank": "Сбербанк", "ppvz_office_name": "ПВЗ Москва",
+    "ppvz_inn": "7700000000", "ppvz_supplier_name": "ИП Партнер", "office_name": "Коледино",
+    "site_country": "Россия", "gi_box_type_name": "Без коробов", "declaration_number": "",
+    "kiz": "", "rebill_logistic_org": "",
+}
+
+
+def make_finance_report(count: int, seed: int = 1) -> list[dict]:
+    # Rows shaped like the reportDetailByPeriod response
+    rnd = random.Random(seed)
+    fields = {field for field in finance_report._REPORT_FIELDS if field}
+    rows = []
+    for i in range(count):
+        row = {field: round(rnd.uniform(0, 5000), 2) for field in fields}
+        row.update(_FIN_REPORT_TEXT_FIELDS)
+        row.update({
+            "rrd_id": 1000000 + i,
+            "realizationreport_id": 500000 + i // 1000,
+            "nm_id": 100000 + rnd.randint(0, max(count // 10, 1)),
+            "sa_name": f"art-{i % 1000}",
+            "barcode": str(2000000000000 + i),
+            "order_dt": "2025-01-01T10:00:00",
+            "sale_dt": "2025-01-02T12:00:00",
+            "quantity": rnd.randint(0, 3),
+            "delivery_amount": rnd.randint(0, 1),
+            "return_amount": rnd.randint(0, 1),
+            "ppvz_office_id": rnd.randint(1, 5000),
+            "assembly_id": rnd.randint(0, 10 ** 9),
+            "shk_id": rnd.randint(0, 10 ** 10),
+            "srid": f"{i:x}.{seed}.0",
+        })
+        rows.append(row)
+    return rows
+
+
+def make_product_names(report: list[dict]) -> dict[int, str]:
+    return {row["nm_id"]: f"Товар {row['nm_id']}" for row in report}
+
+
+_OFFICES = [(f"Склад {i}", f"Город {i % 40}", f"Округ {i % 8}") for i in range(120)]
+
+
+def make_warehouse_map() -> dict[str, dict[str, str]]:
+    warehouse_map = {name: {"region": region, "city": city} for name, city, region in _OFFICES}
+    warehouse_map["В пути возвраты на склад WB"] = {"region": "Остальные", "city": "Остальные"}
+    return warehouse_map
+
+
+def make_stocks_report(count: int, seed: int = 1) -> list[dict]:
+    # Items shaped like the warehouse_remains download
+    rnd = random.Random(seed)
+    items = []
+    for i in range(count):
+        warehouses = [{"warehouseName": name, "quantity": rnd.randint(0, 50)}
+                      for name, city, region in rnd.sample(_OFFICES, rnd.randint(1, 12))]
+        warehouses.append({"warehouseName": "В пути до получателей", "quantity": rnd.randint(0, 10)})
+        items.append({
+            "nmId": 100000 + i,
+            "vendorCode": f"art-{i}",
+            "brand": "Brand A",
+            "subjectName": "Футболки",
+            "warehouses": warehouses,
+        })
+    return items
+
+
+def make_sales_stats(count: int, days_count: int = 30, seed: int = 1):
+    # Returns run config, articles and their stats as read_sales_stats builds them
+    rnd = random.Random(seed)
+    config = period_sales._RunConfig(SPREADSHEETS_ID="benchmark", DIFF_DAYS_COUNT=days_count, IS_DEBUG=True)
+    articles_data = [utils.ArticleData(article=100000 + i, seller_article=f"art-{i}",
+                                       brand="Brand A", category="Футболки")
+                     for i in range(count)]
+    stats = [period_sales.SalesStat(
+        article=a.article,
+        seller_article=a.seller_article,
+        brand=a.brand,
+        category=a.category,
+        month_sales=rnd.randint(0, 1000),
+        cur_stocks=rnd.randint(0, 500),
+        middle_in_day_sales=rnd.uniform(0, 30),
+        month_income=rnd.randint(0, 10 ** 6),
+        no_available_days=rnd.randint(0, 30),
+        days_stats=[period_sales.DayStats(sales_count=rnd.randint(0, 40), stocks_count=rnd.randint(0, 500))
+                    for _ in range(days_count)],
+        saleRate=rnd.randint(0, 100),
+        availability="deficient",
+    ) for a in articles_data]
+    return config, articles_data, stats
+
+
+def load_recorded(fixtures_dir: str, name: str, count: int) -> list:
+    # A recorded WB payload (json list) repeated or cut to the wanted size, None if not recorded
+    path = os.path.join(fixtures_dir, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        items = json.load(file)
+    if not items:
+        return None
+    return [items[i % len(items)] for i in range(count)]
@@ -0,0 +1,135 @@
+# Offline benchmarks of the parser transformations, run from src:
+#   python -m benchmarks.run [--scales 1000 10000 100000] [--only name ...] [--output file.json]
+# Recorded WB payloads are taken from --fixtures (voronka_cards.json, fin_report.json,
+# stocks_report.json), otherwise synthetic ones are generated
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+from parser import finance_report, period_sales, stocks_stats, voronka_stats
+from parser.report_cache import dump_row
+from benchmarks import fixtures
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_SCALES = [1000, 10000, 100000]
+DEFAULT_FIXTURES_DIR = os.path.join(THIS_DIR, "fixtures")
+DEFAULT_RESULTS_DIR = os.path.join(THIS_DIR, "results")
+
+
+def _voronka_cards(scale: int, fixtures_dir: str) -> list[dict]:
+    return (fixtures.load_recorded(fixtures_dir, "voronka_cards", scale)
+            or fixtures.make_voronka_cards(scale))
+
+
+def _voronka_advanced(scale: int, fixtures_dir: str):
+    cards = _voronka_cards(scale, fixtures_dir)
+    return lambda: [dump_row(voronka_stats._card_to_advanced_stat(card)) for card in cards]
+
+
+def _parse_report_detail(scale: int, fixtures_dir: str):
+    report = (fixtures.load_recorded(fixtures_dir, "fin_report", scale)
+              or fixtures.make_finance_report(scale))
+    product_names = fixtures.make_product_names(report)
+    return lambda: finance_report.parse_report_detail(report, product_names)
+
+
+def _stock_stats(scale: int, fixtures_dir: str):
+    stocks_data = (fixtures.load_recorded(fixtures_dir, "stocks_report", scale)
+                   or fixtures.make_stocks_report(scale))
+    warehouse_map = fixtures.make_warehouse_map()
+    return lambda: stocks_stats.parse_stocks_report(stocks_data, warehouse_map)
+
+
+def _sales_stats_table(scale: int, fixtures_dir: str):
+    config, articles_data, stats = fixtures.make_sales_stats(scale)
+    return lambda: period_sales.convert_sales_stats_to_table(config, articles_data, stats)
+
+
+# name -> setup(scale, fixtures_dir) that prepares the payload and returns the measured call
+BENCHMARKS = {
+    "voronka_advanced": _voronka_advanced,
+    "parse_report_detail": _parse_report_detail,
+    "stock_stats": _stock_stats,
+    "sales_stats_table": _sales_stats_table,
+}
+
+
+def _measure(run, repeat: int) -> tuple[float, int]:
+    # Best time of the runs and the peak of traced memory of a separate run,
+    # tracing slows the code down so it is not timed
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def run_benchmarks(names: list[str], scales: list[int], repeat: int, fixtures_dir: str) -> list[dict]:
+    results = []
+    for name in names:
+        for scale in scales:
+            run = BENCHMARKS[name](scale, fixtures_dir)
+            seconds, peak = _measure(run, repeat)
+            results.append({
+                "name": name,
+                "scale": scale,
+                "seconds": round(seconds, 6),
+                "rows_per_sec": round(scale / seconds) if seconds else None,
+                "peak_memory_bytes": peak,
+            })
+            print(f"{name:>28} {scale:>7}: {seconds:8.3f}s {peak / 2 ** 20:9.1f} MiB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of parser transformations")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES_DIR)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.scales, args.repeat, args.fixtures)
+
+    commit = _git_commit()
+    output = args.output
+    if output is None:
+        os.makedirs(DEFAULT_RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(DEFAULT_RESULTS_DIR, f"{stamp}-{commit or 'nogit'}.json")
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump({
+            "commit": commit,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "results": results,
+        }, file, ensure_ascii=False, indent=2)
+    print(f"Results: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,199 @@
-from fastapi import FastAPI, Query, Body
+from fastapi import FastAPI, Query, Body, Request, Response, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
+import json
+import logging
 from datetime import datetime
+from typing import AsyncIterator, Optional
 
 from tasks import register_tasks
-from parser import voronka_stats, region_sales, finance_report
+from parser import voronka_stats, region_sales
+from parser import http_sessions, async_utils, utils, google_service, fin_report_jobs
+from parser.report_cache import CachedReport, get_ttl, open_report, report_cache
 from parser.models import *
+from parser.parser_exceptions import IncompleteDataExc, UnathorizedExc
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     register_tasks()
     yield
+    fin_report_jobs.shutdown()
+    http_sessions.close_sessions()
+    await async_utils.close_clients()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
-@app.get("/voronka-stats", response_model=list[voronka_stats.VoronkaStat])
-def voronka_stats_handler(
+@app.exception_handler(IncompleteDataExc)
+async def incomplete_data_handler(request: Request, exc: IncompleteDataExc):
+    return JSONResponse(status_code=502, content={"detail": str(exc)})
+
+
+@app.exception_handler(UnathorizedExc)
+async def unauthorized_handler(request: Request, exc: UnathorizedExc):
+    return JSONResponse(status_code=401, content={"detail": str(exc) or "WB token is not valid"})
+
+
+_MEDIA_TYPES = {
+    ReportFormat.JSON: "application/json",
+    ReportFormat.NDJSON: "application/x-ndjson",
+}
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _report_response(request: Request, report: CachedReport, fmt: ReportFormat) -> Response:
+    etag = report.etag if fmt == ReportFormat.JSON else report.etag[:-1] + f'-{fmt.value}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={report.max_age()}",
+    }
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    body = report.to_json_array() if fmt == ReportFormat.JSON else report.to_ndjson()
+    return Response(content=body, media_type=_MEDIA_TYPES[fmt], headers=headers)
+
+
+# The status is sent with the first part of the body. A report that fails after it
+# ends with an {"error": ...} object: the last element of the JSON array or the last
+# NDJSON line, rows never have an "error" field
+def _error_marker(err: Exception) -> bytes:
+    logging.error(f"Report stream failed after the first rows: {err}")
+    return json.dumps({"error": str(err) or type(err).__name__}, ensure_ascii=False).encode()
+
+
+async def _json_array(first: Optional[bytes], parts) -> AsyncIterator[bytes]:
+    if first is None:
+        yield b"[]"
+        return
+    yield b"[" + first.replace(b"\n", b",")
+    try:
+        async for part in parts:
+            yield part.replace(b"\n", b",")
+    except Exception as err:
+        yield b"," + _error_marker(err)
+    yield b"]"
+
+
+async def _ndjson(first: Optional[bytes], parts) -> AsyncIterator[bytes]:
+    if first is None:
+        return
+    yield first
+    try:
+        async for part in parts:
+            yield part
+    except Exception as err:
+        yield b"\n" + _error_marker(err)
+    yield b"\n"
+
+
+async def _streaming_response(request: Request, endpoint: str, spreadsheets_id: str,
+                              periods: tuple, fmt: ReportFormat, make_rows) -> Response:
+    # Rows are serialized once as they are built, response_model is only used for the docs
+    report = await open_report(endpoint, spreadsheets_id, periods, make_rows)
+    if isinstance(report, CachedReport):
+        return _report_response(request, report, fmt)
+
+    # errors before the first page still get a proper status code
+    first = await anext(report, None)
+    frame = _json_array if fmt == ReportFormat.JSON else _ndjson
+    headers = {"Cache-Control": f"private, max-age={get_ttl(*periods)}"}
+    return StreamingResponse(frame(first, report), media_type=_MEDIA_TYPES[fmt], headers=headers)
+
+
+@app.get("/voronka-stats", response_model=None,
+         responses={200: {"model": list[voronka_stats.VoronkaStat]}})
+async def voronka_stats_handler(
+    request: Request,
     spreadsheets_id: str = Query(..., description="Id таблицы"),
     start_date: datetime = Query(..., description="Начало периода"),
     end_date: datetime = Query(..., description="Конец периода"),
+    fmt: ReportFormat = Query(ReportFormat.JSON, alias="format", description="json или ndjson"),
 ):
     period = WbPeriod(start=start_date, end=end_date)
-    stats = voronka_stats.get_voronka_stats(spreadsheets_id, period)
-    return stats
+    return await _streaming_response(
+        request, "voronka-stats", spreadsheets_id, (period,), fmt,
+        lambda: voronka_stats.iter_voronka_stats_async(spreadsheets_id, period))
 
 
-@app.post("/voronka-adv-stats", response_model=list[voronka_stats.VoronkaAdvancedStat])
-def voronka_advanced_stats_handler(
+@app.post("/voronka-adv-stats", response_model=None,
+         responses={200: {"model": list[voronka_stats.VoronkaAdvancedStat]}})
+async def voronka_advanced_stats_handler(
+    request: Request,
     spreadsheets_id: str = Query(..., description="ID таблицы"),
     body: AdvancedPeriodBody = Body(...,
-                                    description="Периоды: selected и past")
+                                    description="Периоды: selected и past"),
+    fmt: ReportFormat = Query(ReportFormat.JSON, alias="format", description="json или ndjson"),
 ):
-    stats = voronka_stats.get_advanced_voronka_stats(
-        spreadsheets_id=spreadsheets_id,
-        selected=body.selected,
-        past=body.past
-    )
-    return stats
+    return await _streaming_response(
+        request, "voronka-adv-stats", spreadsheets_id, (body.selected, body.past), fmt,
+        lambda: voronka_stats.iter_advanced_voronka_stats_async(
+            spreadsheets_id=spreadsheets_id,
+            selected=body.selected,
+            past=body.past
+        ))
 
 
-@app.get("/region-sales", response_model=list[region_sales.RegionSale])
-def region_stats_handler(
+@app.get("/region-sales", response_model=None,
+         responses={200: {"model": list[region_sales.RegionSale]}})
+async def region_stats_handler(
+    request: Request,
     spreadsheets_id: str = Query(..., description="Id таблицы"),
     start_date: datetime = Query(..., description="Начало периода"),
     end_date: datetime = Query(..., description="Конец периода"),
+    fmt: ReportFormat = Query(ReportFormat.JSON, alias="format", description="json или ndjson"),
 ):
     period = WbPeriod(start=start_date, end=end_date)
-    stats = region_sales.get_region_sales(spreadsheets_id, period)
-    return stats
+    return await _streaming_response(
+        request, "region-sales", spreadsheets_id, (period,), fmt,
+        lambda: region_sales.iter_region_sales_async(spreadsheets_id, period))
 
 
-@app.post("/fin-report")
+@app.post("/fin-report", status_code=202, response_model=fin_report_jobs.FinReportJob)
 def fin_report_handler(payload: FinanceReportRequest):
     period = WbPeriod(
         start=payload.start_date,
         end=payload.end_date
     )
-    finance_report.write_finance_report(
-        spreadsheet_id=payload.spreadsheets_id,
+    return fin_report_jobs.submit_fin_report(
+        spreadsheets_id=payload.spreadsheets_id,
         token=payload.token,
-        period=period,
-        sheet_name=payload.sheet_name
-    )
\ No newline at end of file
+        sheet_name=payload.sheet_name,
+        period=period
+    )
+
+
+@app.get("/fin-report/{job_id}", response_model=fin_report_jobs.FinReportJob)
+def fin_report_status_handler(job_id: str):
+    job = fin_report_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/cache-stats")
+def cache_stats_handler():
+    stats = utils.get_sheets_cache_stats()
+    stats["reports"] = report_cache.stats()
+    return stats
+
+
+@app.get("/sheets-pool-stats")
+def sheets_pool_stats_handler():
+    return google_service.get_pool_stats()
+
+
+@app.post("/cache/invalidate")
+def cache_invalidate_handler(
+    spreadsheets_id: Optional[str] = Query(None, description="Id таблицы, без него сбрасывается весь кэш"),
+):
+    utils.invalidate_spreadsheet_cache(spreadsheets_id)
+    report_cache.invalidate(spreadsheets_id)
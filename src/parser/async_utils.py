@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Union
+from urllib.parse import urlsplit
+import httpx
+
+from .parsers_config import *
+from .parser_exceptions import *
+from . import utils
+from .utils import RequestTypes, ArticleData, rate_limiter
+
+# One keep-alive client per WB host, bound to the application event loop
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _get_client(url: str) -> httpx.AsyncClient:
+    host = urlsplit(url).netloc
+    client = _clients.get(host)
+    if client is None:
+        pool_size = HTTP_POOL_SIZES.get(host, HTTP_POOL_MAXSIZE)
+        limits = httpx.Limits(max_connections=None,
+                              max_keepalive_connections=pool_size)
+        client = httpx.AsyncClient(limits=limits)
+        _clients[host] = client
+    return client
+
+
+async def close_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+async def _send_request(url: str,
+                        headers: dict,
+                        attempts: int,
+                        on_error_wait_sec: int,
+                        mode: RequestTypes,
+                        body: dict = None) -> Union[list[dict], dict]:
+    resp = None
+    token = headers.get("Authorization", "")
+    timeout = httpx.Timeout(on_error_wait_sec, pool=None)
+    for i in range(attempts):
+        await rate_limiter.wait_async(url, token)
+        try:
+            client = _get_client(url)
+            if mode == RequestTypes.GET:
+                resp = await client.get(url, headers=headers, timeout=timeout)
+            elif mode == RequestTypes.POST:
+                if body is None:
+                    body = {}
+                resp = await client.post(url, headers=headers,
+                                         json=body, timeout=timeout)
+            if resp.status_code == 204:
+                return []
+            if resp.status_code != 200:
+                logging.error(
+                    f"Api error (status={resp.status_code}) resp = {resp.text}, url = {url}")
+            if resp.status_code == 401:
+                raise UnathorizedExc()
+            if resp.status_code != 200:
+                raise Exception(f"Request error, status: {resp.status_code}")
+
+            data = json.loads(resp.text)
+            return data
+        except UnathorizedExc as err:
+            raise
+        except Exception as err:
+            if resp is not None and resp.status_code == 429:
+                await asyncio.sleep(on_error_wait_sec)
+                continue
+            logging.exception(err)
+    logging.error(
+        f"Invalid request: url={url}" + (f", status={resp.status_code}" if resp is not None else ""))
+    return None
+
+
+async def api_get(url: str, headers: dict,
+                  attempts: int = REQUEST_ATTEMPT_COUNT,
+                  req_wait_sec=REQUEST_WAIT_SEC) -> Union[list[dict], dict]:
+    return await _send_request(url, headers, attempts, req_wait_sec, RequestTypes.GET)
+
+
+async def api_post(url: str, headers: dict, body: dict,
+                   attempts: int = REQUEST_ATTEMPT_COUNT,
+                   req_wait_sec=REQUEST_WAIT_SEC) -> Union[list[dict], dict]:
+    return await _send_request(url, headers, attempts, req_wait_sec, RequestTypes.POST, body)
+
+
+# Google client is blocking, so sheets calls run in the default thread pool
+async def get_article_data(table_id: str) -> list[ArticleData]:
+    return await asyncio.to_thread(utils.get_article_data, table_id)
+
+
+async def get_wb_token(table_id: str) -> str:
+    return await asyncio.to_thread(utils.get_wb_token, table_id)
+
+
+async def call_with_token(table_id: str, fn: Callable[[str], Awaitable[Any]]) -> Any:
+    # A 401 means the token in the sheet was replaced, the cached one is dropped
+    # and the call is made once more with the token read again
+    try:
+        return await fn(await get_wb_token(table_id))
+    except UnathorizedExc:
+        utils.invalidate_spreadsheet_cache(table_id)
+        return await fn(await get_wb_token(table_id))
+
+
+async def iter_with_token(table_id: str, make_iter: Callable[[str], AsyncIterator]) -> AsyncIterator:
+    # Same as call_with_token, the retry is only possible before anything was yielded
+    started = False
+    try:
+        async for item in make_iter(await get_wb_token(table_id)):
+            started = True
+            yield item
+        return
+    except UnathorizedExc:
+        utils.invalidate_spreadsheet_cache(table_id)
+        if started:
+            raise
+    async for item in make_iter(await get_wb_token(table_id)):
+        yield item
@@ -1,7 +1,11 @@
 import os
-from datetime import date, timedelta
+import json
+import threading
+import time
+from datetime import date, datetime, timedelta
 from typing import Dict, Optional
-from sqlalchemy import create_engine, Integer, Date, select, delete
+from sqlalchemy import create_engine, Integer, Float, Date, DateTime, String, Text, LargeBinary, select, delete, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -9,8 +13,11 @@ BASE_NAME = "table.db"
 TEST_NAME = "test.db"
 
 MAX_DAYS_SALES = 20
+# rows per INSERT, keeps statements below the SQLite bound parameters limit
+UPSERT_CHUNK_SIZE = 5000
 
 _sessionMaker = None
+_init_lock = threading.Lock()
 
 class Base(DeclarativeBase):
     pass
@@ -22,24 +29,73 @@ class DailyStock(Base):
     day: Mapped[date] = mapped_column(Date, primary_key=True)
     stock_count: Mapped[int] = mapped_column(Integer, nullable=False)
 
+
+class DailyOrders(Base):
+    __tablename__ = "daily_orders"
+    article: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    orders_count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class OrdersSyncDay(Base):
+    # kept per article, an article added to a sheet has no synced days yet
+    __tablename__ = "orders_sync_article_days"
+    article: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+
+
+class SheetSnapshot(Base):
+    __tablename__ = "sheet_snapshots"
+    spreadsheet_id: Mapped[str] = mapped_column(String, primary_key=True)
+    range_name: Mapped[str] = mapped_column(String, primary_key=True)
+    values_json: Mapped[str] = mapped_column(Text, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class CardTitle(Base):
+    __tablename__ = "card_titles"
+    nm_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    seller_key: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    title: Mapped[str] = mapped_column(String, nullable=False)
+
+
+class CardsSyncState(Base):
+    __tablename__ = "cards_sync_state"
+    seller_key: Mapped[str] = mapped_column(String, primary_key=True)
+    cursor_updated_at: Mapped[str] = mapped_column(String, nullable=False)
+    cursor_nm_id: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class ReportCacheEntry(Base):
+    __tablename__ = "report_cache"
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    spreadsheet_id: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    body: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    etag: Mapped[str] = mapped_column(String, nullable=False)
+    expires_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+
 def _delete_old_records():
     cutoff_date = date.today() - timedelta(days=MAX_DAYS_SALES)
     with get_session() as session:
-        stmt = delete(DailyStock).where(DailyStock.day < cutoff_date)
-        session.execute(stmt)
+        for table in (DailyStock, DailyOrders, OrdersSyncDay):
+            stmt = delete(table).where(table.day < cutoff_date)
+            session.execute(stmt)
+        session.execute(delete(ReportCacheEntry).where(ReportCacheEntry.expires_at < time.time()))
         session.commit()
 
 def init_db(file_name: str = BASE_NAME):
     global _sessionMaker
-    if _sessionMaker:
-        return
+    with _init_lock:
+        if _sessionMaker:
+            return
 
-    db_raw_path = os.path.join(THIS_DIR, file_name)
-    db_path = f"sqlite:///{db_raw_path}"
+        db_raw_path = os.path.join(THIS_DIR, file_name)
+        db_path = f"sqlite:///{db_raw_path}"
 
-    engine = create_engine(db_path, echo=False)
-    _sessionMaker = sessionmaker(bind=engine)
-    Base.metadata.create_all(engine)
+        engine = create_engine(db_path, echo=False)
+        _sessionMaker = sessionmaker(bind=engine)
+        Base.metadata.create_all(engine)
 
     _delete_old_records()
     
@@ -62,16 +118,35 @@ def get_session():
     return _sessionMaker()
 
 
-def save_daily_stocks(stock_data: Dict[int, int], target_day: date):
+def _chunks(items: list, size: int = UPSERT_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def save_daily_stocks(stock_data: Dict[int, int], target_day: date) -> tuple[int, int]:
+    # Returns (inserted, updated) rows count
+    articles = list(stock_data.keys())
+    stmt = insert(DailyStock)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DailyStock.article, DailyStock.day],
+        set_={"stock_count": stmt.excluded.stock_count})
+
+    inserted = 0
+    updated = 0
     with get_session() as session:
-        for article, count in stock_data.items():
-            existing = session.get(DailyStock, (article, target_day))
-            if existing:
-                existing.stock_count = count
-            else:
-                session.add(DailyStock(article=article,
-                            stock_count=count, day=target_day))
+        for chunk in _chunks(articles):
+            existing_stmt = select(DailyStock.article).where(DailyStock.day == target_day,
+                                                             DailyStock.article.in_(chunk))
+            existing_count = len(session.scalars(existing_stmt).all())
+            updated += existing_count
+            inserted += len(chunk) - existing_count
+
+            session.execute(stmt, [
+                {"article": article, "day": target_day, "stock_count": stock_data[article]}
+                for article in chunk
+            ])
         session.commit()
+    return inserted, updated
 
 
 def get_article_day_stocks(article: int, target_day: date) -> Optional[int]:
@@ -85,3 +160,156 @@ def get_day_stocks(target_day: date) -> Dict[int, int]:
         stmt = select(DailyStock).where(DailyStock.day == target_day)
         rows = session.scalars(stmt).all()
         return {r.article: r.stock_count for r in rows}
+
+
+def get_stocks_matrix(articles: list[int], start_day: date, days_count: int) -> Dict[int, list[Optional[int]]]:
+    # Stocks of every article for days start_day .. start_day + days_count - 1, None where missing
+    res = {a: [None] * days_count for a in articles}
+    end_day = start_day + timedelta(days=days_count - 1)
+    with get_session() as session:
+        for chunk in _chunks(articles):
+            stmt = select(DailyStock.article, DailyStock.day, DailyStock.stock_count).where(
+                DailyStock.article.in_(chunk),
+                DailyStock.day >= start_day,
+                DailyStock.day <= end_day)
+            for article, day, count in session.execute(stmt):
+                res[article][(day - start_day).days] = count
+    return res
+
+
+def save_daily_orders(orders_data: Dict[int, Dict[date, int]], days: list[date]):
+    # Rewrites the given days completely, so orders canceled since the last sync disappear
+    articles = list(orders_data.keys())
+    with get_session() as session:
+        for chunk in _chunks(articles):
+            stmt = delete(DailyOrders).where(DailyOrders.article.in_(chunk),
+                                             DailyOrders.day.in_(days))
+            session.execute(stmt)
+        session.add_all(DailyOrders(article=article, day=day, orders_count=count)
+                        for article, days_orders in orders_data.items()
+                        for day, count in days_orders.items()
+                        if day in days and count)
+        session.commit()
+
+
+def get_daily_orders(articles: list[int], start_day: date, end_day: date) -> Dict[int, Dict[date, int]]:
+    res = {a: {} for a in articles}
+    with get_session() as session:
+        for chunk in _chunks(articles):
+            stmt = select(DailyOrders).where(DailyOrders.article.in_(chunk),
+                                             DailyOrders.day >= start_day,
+                                             DailyOrders.day <= end_day)
+            for r in session.scalars(stmt):
+                res[r.article][r.day] = r.orders_count
+    return res
+
+
+def mark_orders_synced(articles: list[int], days: list[date]):
+    if not articles or not days:
+        return
+    rows = [(article, day) for article in articles for day in days]
+    stmt = insert(OrdersSyncDay).on_conflict_do_nothing()
+    with get_session() as session:
+        for chunk in _chunks(rows):
+            session.execute(stmt, [{"article": article, "day": day} for article, day in chunk])
+        session.commit()
+
+
+def get_orders_synced_days(articles: list[int], start_day: date, end_day: date) -> set[date]:
+    # Days synced for every one of the articles
+    articles = list(set(articles))
+    counts: Dict[date, int] = {}
+    with get_session() as session:
+        for chunk in _chunks(articles):
+            stmt = select(OrdersSyncDay.day, func.count()).where(
+                OrdersSyncDay.article.in_(chunk),
+                OrdersSyncDay.day >= start_day,
+                OrdersSyncDay.day <= end_day).group_by(OrdersSyncDay.day)
+            for day, count in session.execute(stmt):
+                counts[day] = counts.get(day, 0) + count
+    return {day for day, count in counts.items() if count == len(articles)}
+
+
+def save_card_titles(seller_key: str, titles: Dict[int, str],
+                     cursor_updated_at: Optional[str] = None, cursor_nm_id: Optional[int] = None):
+    # Titles and the cards cursor they were read up to are saved in one transaction
+    items = list(titles.items())
+    stmt = insert(CardTitle)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CardTitle.nm_id],
+        set_={"seller_key": stmt.excluded.seller_key, "title": stmt.excluded.title})
+
+    with get_session() as session:
+        for chunk in _chunks(items):
+            session.execute(stmt, [
+                {"nm_id": nm_id, "seller_key": seller_key, "title": title}
+                for nm_id, title in chunk
+            ])
+        if cursor_updated_at is not None and cursor_nm_id is not None:
+            session.merge(CardsSyncState(seller_key=seller_key,
+                                         cursor_updated_at=cursor_updated_at,
+                                         cursor_nm_id=cursor_nm_id))
+        session.commit()
+
+
+def get_cards_cursor(seller_key: str) -> tuple[Optional[str], Optional[int]]:
+    with get_session() as session:
+        state = session.get(CardsSyncState, seller_key)
+        if not state:
+            return None, None
+        return state.cursor_updated_at, state.cursor_nm_id
+
+
+def get_card_titles(seller_key: str) -> Dict[int, str]:
+    with get_session() as session:
+        stmt = select(CardTitle.nm_id, CardTitle.title).where(CardTitle.seller_key == seller_key)
+        return {nm_id: title for nm_id, title in session.execute(stmt)}
+
+
+def save_sheet_snapshot(spreadsheet_id: str, range_name: str, values: list[list]):
+    with get_session() as session:
+        session.merge(SheetSnapshot(spreadsheet_id=spreadsheet_id,
+                                    range_name=range_name,
+                                    values_json=json.dumps(values, default=str, ensure_ascii=False),
+                                    updated_at=datetime.now()))
+        session.commit()
+
+
+def delete_sheet_snapshot(spreadsheet_id: str, range_name: str):
+    with get_session() as session:
+        session.execute(delete(SheetSnapshot).where(SheetSnapshot.spreadsheet_id == spreadsheet_id,
+                                                    SheetSnapshot.range_name == range_name))
+        session.commit()
+
+
+def get_sheet_snapshot(spreadsheet_id: str, range_name: str, max_age: timedelta) -> Optional[list[list]]:
+    with get_session() as session:
+        snapshot = session.get(SheetSnapshot, (spreadsheet_id, range_name))
+        if not snapshot or datetime.now() - snapshot.updated_at > max_age:
+            return None
+        return json.loads(snapshot.values_json)
+
+
+def save_report_cache_entry(key: str, spreadsheet_id: str, body: bytes, etag: str, expires_at: float):
+    with get_session() as session:
+        session.merge(ReportCacheEntry(key=key, spreadsheet_id=spreadsheet_id,
+                                       body=body, etag=etag, expires_at=expires_at))
+        session.commit()
+
+
+def get_report_cache_entry(key: str) -> Optional[ReportCacheEntry]:
+    with get_session() as session:
+        entry = session.get(ReportCacheEntry, key)
+        if not entry or entry.expires_at < time.time():
+            return None
+        session.expunge(entry)
+        return entry
+
+
+def delete_report_cache_entries(spreadsheet_id: Optional[str] = None):
+    with get_session() as session:
+        stmt = delete(ReportCacheEntry)
+        if spreadsheet_id is not None:
+            stmt = stmt.where(ReportCacheEntry.spreadsheet_id == spreadsheet_id)
+        session.execute(stmt)
+        session.commit()
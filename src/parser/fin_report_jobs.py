@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+from pydantic import BaseModel
+
+from . import finance_report
+from . import utils
+from .models import WbPeriod
+from .parsers_config import *
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class FinReportJob(BaseModel):
+    job_id: str
+    status: JobStatus = JobStatus.QUEUED
+    spreadsheets_id: str
+    sheet_name: str
+    period: WbPeriod
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    rows_read: int = 0
+    rows_written: int = 0
+    error: Optional[str] = None
+
+
+_executor = ThreadPoolExecutor(max_workers=FIN_REPORT_MAX_WORKERS,
+                               thread_name_prefix="fin-report")
+_jobs: dict[str, FinReportJob] = {}
+# job key -> id of the queued or running job for it
+_active: dict[tuple, str] = {}
+_lock = threading.Lock()
+
+
+def _job_key(spreadsheets_id: str, token: str, sheet_name: str, period: WbPeriod) -> tuple:
+    return (spreadsheets_id, utils.get_token_key(token), sheet_name, period.start, period.end)
+
+
+def _delete_old_jobs():
+    cutoff = time.time() - FIN_REPORT_JOB_KEEP_SEC
+    old_ids = [job_id for job_id, job in _jobs.items()
+               if job.finished_at and job.finished_at.timestamp() < cutoff]
+    for job_id in old_ids:
+        del _jobs[job_id]
+
+
+def _run_job(job: FinReportJob, key: tuple, token: str):
+    def on_progress(rows_read: int, rows_written: int):
+        job.rows_read = rows_read
+        job.rows_written = rows_written
+
+    job.started_at = datetime.now()
+    job.status = JobStatus.RUNNING
+    try:
+        finance_report.write_finance_report(job.spreadsheets_id, token, job.sheet_name,
+                                            job.period, on_progress=on_progress)
+        job.status = JobStatus.DONE
+    except Exception as err:
+        logging.exception(f"Fin report job {job.job_id} failed")
+        job.error = str(err)
+        job.status = JobStatus.FAILED
+    finally:
+        job.finished_at = datetime.now()
+        with _lock:
+            _active.pop(key, None)
+
+
+def submit_fin_report(spreadsheets_id: str, token: str, sheet_name: str, period: WbPeriod) -> FinReportJob:
+    # Returns the already queued or running job for the same report instead of starting a new one
+    key = _job_key(spreadsheets_id, token, sheet_name, period)
+    with _lock:
+        job_id = _active.get(key)
+        if job_id is not None:
+            return _jobs[job_id]
+
+        _delete_old_jobs()
+        job = FinReportJob(job_id=uuid.uuid4().hex,
+                           spreadsheets_id=spreadsheets_id,
+                           sheet_name=sheet_name,
+                           period=period,
+                           created_at=datetime.now())
+        _jobs[job.job_id] = job
+        _active[key] = job.job_id
+
+    _executor.submit(_run_job, job, key, token)
+    logging.info(f"Fin report job {job.job_id} queued")
+    return job
+
+
+def get_job(job_id: str) -> Optional[FinReportJob]:
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -1,36 +1,72 @@
 import logging
-import time
 from datetime import datetime
+from typing import AsyncIterator, Callable, Iterator, Optional
 
 from .models import WbPeriod
 from . import utils
+from . import async_utils
+from .data import db
 from .parsers_config import *
+from .parser_exceptions import IncompleteDataExc
+from .report_table import ReportTable
 
 
-def get_product_names(token: str) -> dict:
-    headers = utils.get_auth_header(token)
+PRODUCT_CARDS_LIMIT = 100
+PRODUCT_CARDS_MAX_PAGES = 30
+
+
+def _build_cards_payload(cursor_updated_at, cursor_nm_id) -> dict:
+    cursor = {"limit": PRODUCT_CARDS_LIMIT}
+    if cursor_updated_at is not None and cursor_nm_id is not None:
+        cursor["updatedAt"] = cursor_updated_at
+        cursor["nmID"] = cursor_nm_id
 
-    cursor_updated_at = None
-    cursor_nm_id = None
-
-    result = {}
-    limit = 100
-    max_pages = 30
-    for i in range(max_pages):
-        cursor = {"limit": limit}
-        if cursor_updated_at is not None and cursor_nm_id is not None:
-            cursor["updatedAt"] = cursor_updated_at
-            cursor["nmID"] = cursor_nm_id
-
-        payload = {
-            "settings": {
-                "filter": {
-                    "withPhoto": -1
-                },
-                "cursor": cursor
-            }
+    # Oldest changes first, so the saved cursor points to the last synced card
+    return {
+        "settings": {
+            "sort": {
+                "ascending": True
+            },
+            "filter": {
+                "withPhoto": -1
+            },
+            "cursor": cursor
         }
+    }
+
+
+def _save_cards_page(seller_key: str, response: dict) -> tuple:
+    titles = {}
+    cards = response.get("cards", [])
+    for card in cards:
+        nm_id = card.get("nmID")
+        title = card.get("title")
+
+        if nm_id is None or title is None:
+            continue
 
+        titles[nm_id] = title
+
+    cursor_data = response.get("cursor", {})
+    cursor_updated_at = cursor_data.get("updatedAt")
+    cursor_nm_id = cursor_data.get("nmID")
+    total = cursor_data.get("total", 0)
+
+    db.save_card_titles(seller_key, titles, cursor_updated_at, cursor_nm_id)
+
+    is_last = (total < PRODUCT_CARDS_LIMIT or
+               cursor_updated_at is None or cursor_nm_id is None)
+    return cursor_updated_at, cursor_nm_id, is_last
+
+
+def get_product_names(token: str) -> dict:
+    # Titles are stored locally, only cards changed since the last sync are requested
+    headers = utils.get_auth_header(token)
+    seller_key = utils.get_token_key(token)
+    cursor_updated_at, cursor_nm_id = db.get_cards_cursor(seller_key)
+
+    for i in range(PRODUCT_CARDS_MAX_PAGES):
+        payload = _build_cards_payload(cursor_updated_at, cursor_nm_id)
         response = utils.api_post(
             CARDS_LIST_URL,
             headers=headers,
@@ -38,137 +74,224 @@ def get_product_names(token: str) -> dict:
             attempts=5,
             req_wait_sec=CARDS_WAIT_TIME
         )
-        time.sleep(3)
 
         if not response:
             logging.error("Empty response from WB cards API")
             break
 
-        cards = response.get("cards", [])
-        for card in cards:
-            nm_id = card.get("nmID")
-            title = card.get("title")
+        cursor_updated_at, cursor_nm_id, is_last = _save_cards_page(
+            seller_key, response)
+        if is_last:
+            break
+
+    return db.get_card_titles(seller_key)
 
-            if nm_id is None or title is None:
-                continue
 
-            result[nm_id] = title
+async def get_product_names_async(token: str) -> dict:
+    headers = utils.get_auth_header(token)
+    seller_key = utils.get_token_key(token)
+    cursor_updated_at, cursor_nm_id = db.get_cards_cursor(seller_key)
 
-        cursor_data = response.get("cursor", {})
-        cursor_updated_at = cursor_data.get("updatedAt")
-        cursor_nm_id = cursor_data.get("nmID")
-        total = cursor_data.get("total", 0)
+    for i in range(PRODUCT_CARDS_MAX_PAGES):
+        payload = _build_cards_payload(cursor_updated_at, cursor_nm_id)
+        response = await async_utils.api_post(
+            CARDS_LIST_URL,
+            headers=headers,
+            body=payload,
+            attempts=5,
+            req_wait_sec=CARDS_WAIT_TIME
+        )
 
-        if total < limit:
+        if not response:
+            logging.error("Empty response from WB cards API")
             break
-        if cursor_updated_at is None or cursor_nm_id is None:
+
+        cursor_updated_at, cursor_nm_id, is_last = _save_cards_page(
+            seller_key, response)
+        if is_last:
             break
 
-    return result
-
-
-def parse_report_detail(data: list[dict], product_names: dict) -> list[dict]:
-    if len(data) == 0:
-        return []
-
-    parsed: list[dict] = []
-
-    for i, row in enumerate(data, start=1):
-        nm_id = int(row.get("nm_id"))
-        parsed.append({
-            "№": i,
-            "Номер поставки": row.get("realizationreport_id"),
-            "Артикул" : str(nm_id),
-            "Предмет": row.get("subject_name"),
-            "Код номенклатуры": row.get("nm_id"),
-            "Бренд": row.get("brand_name"),
-            "Артикул поставщика": row.get("sa_name"),
-            "Название": product_names.get(nm_id, ""),
-            "Размер": row.get("ts_name"),
-            "Баркод": row.get("barcode"),
-            "Тип документа": row.get("doc_type_name"),
-            "Обоснование для оплаты": row.get("supplier_oper_name"),
-            "Дата заказа покупателем": row.get("order_dt"),
-            "Дата продажи": row.get("sale_dt"),
-            "Кол-во": row.get("quantity"),
-            "Цена розничная": row.get("retail_price"),
-            "Вайлдберриз реализовал Товар (Пр)": row.get("retail_amount"),
-            "Согласованный продуктовый дисконт %": row.get("product_discount_for_report"),
-            "Промокод %": row.get("sale_price_promocode_discount_prc"),
-            "Итоговая согласованная скидка %": row.get("sale_percent"),
-            "Цена розничная с учетом согласованной скидки": row.get("retail_price_withdisc_rub"),
-            "Размер снижения кВВ из-за рейтинга %": row.get("sup_rating_prc_up"),
-            "Размер изменения кВВ из-за акции %": row.get("ppvz_kvw_prc"),
-            "Скидка постоянного Покупателя (СПП) %": row.get("ppvz_spp_prc"),
-            "Размер кВВ %": row.get("ppvz_kvw_prc_base"),
-            "Размер кВВ без НДС % Базовый": row.get("ppvz_kvw_prc_base"),
-            "Итоговый кВВ без НДС %": row.get("ppvz_kvw_prc"),
-            "Вознаграждение с продаж до вычета услуг поверенного без НДС": row.get("ppvz_sales_commission"),
-            "Возмещение за выдачу и возврат товаров на ПВЗ": row.get("ppvz_reward"),
-            "Эквайринг / Комиссии за организацию платежей": row.get("acquiring_fee"),
-            "Размер комиссии за эквайринг / Комиссии за организацию платежей %": row.get("acquiring_percent"),
-            "Тип платежа за Эквайринг / Комиссии за организацию платежей": row.get("payment_processing"),
-            "Вознаграждение Вайлдберриз (ВВ) без НДС": row.get("ppvz_vw"),
-            "НДС с Вознаграждения Вайлдберриз": row.get("ppvz_vw_nds"),
-            "К перечислению Продавцу за реализованный Товар": row.get("ppvz_for_pay"),
-            "Количество доставок": row.get("delivery_amount"),
-            "Количество возврата": row.get("return_amount"),
-            "Услуги по доставке товара покупателю": row.get("delivery_rub"),
-            "Дата начала действия фиксации": row.get("fix_tariff_date_from"),
-            "Дата конца действия фиксации": row.get("fix_tariff_date_to"),
-            "Признак услуги платной доставки": row.get("delivery_amount") > 0,
-            "Общая сумма штрафов": row.get("penalty"),
-            "Корректировка Вознаграждения Вайлдберриз (ВВ)": row.get("additional_payment"),
-            "Виды логистики, штрафов и корректировок ВВ": row.get("bonus_type_name"),
-            "Стикер МП": row.get("sticker_id"),
-            "Наименование банка-эквайера": row.get("acquiring_bank"),
-            "Номер офиса": row.get("ppvz_office_id"),
-            "Наименование офиса доставки": row.get("ppvz_office_name"),
-            "ИНН партнера": row.get("ppvz_inn"),
-            "Партнер": row.get("ppvz_supplier_name"),
-            "Склад": row.get("office_name"),
-            "Страна": row.get("site_country"),
-            "Тип коробов": row.get("gi_box_type_name"),
-            "Номер таможенной декларации": row.get("declaration_number"),
-            "Номер сборочного задания": row.get("assembly_id"),
-            "Код маркировки": row.get("kiz"),
-            "ШК": row.get("shk_id"),
-            "Srid": row.get("srid"),
-            "Возмещение издержек по перевозке / по складским операциям с товаром": row.get("rebill_logistic_cost"),
-            "Организатор перевозки": row.get("rebill_logistic_org"),
-            "Хранение": row.get("storage_fee"),
-            "Удержания": row.get("deduction"),
-            "Операции на приемке": row.get("acceptance"),
-            "Фиксированный коэффициент склада по поставке": row.get("dlv_prc"),
-        })
-    return parsed
-
-
-def get_report_by_period(token: str, date_from: datetime, date_to: datetime) -> list[dict]:
+    return db.get_card_titles(seller_key)
+
+
+# (column title, WB report field), None marks columns computed in parse_report_detail
+REPORT_COLUMNS = [
+    ("№", None),
+    ("Номер поставки", "realizationreport_id"),
+    ("Артикул", None),
+    ("Предмет", "subject_name"),
+    ("Код номенклатуры", "nm_id"),
+    ("Бренд", "brand_name"),
+    ("Артикул поставщика", "sa_name"),
+    ("Название", None),
+    ("Размер", "ts_name"),
+    ("Баркод", "barcode"),
+    ("Тип документа", "doc_type_name"),
+    ("Обоснование для оплаты", "supplier_oper_name"),
+    ("Дата заказа покупателем", "order_dt"),
+    ("Дата продажи", "sale_dt"),
+    ("Кол-во", "quantity"),
+    ("Цена розничная", "retail_price"),
+    ("Вайлдберриз реализовал Товар (Пр)", "retail_amount"),
+    ("Согласованный продуктовый дисконт %", "product_discount_for_report"),
+    ("Промокод %", "sale_price_promocode_discount_prc"),
+    ("Итоговая согласованная скидка %", "sale_percent"),
+    ("Цена розничная с учетом согласованной скидки", "retail_price_withdisc_rub"),
+    ("Размер снижения кВВ из-за рейтинга %", "sup_rating_prc_up"),
+    ("Размер изменения кВВ из-за акции %", "ppvz_kvw_prc"),
+    ("Скидка постоянного Покупателя (СПП) %", "ppvz_spp_prc"),
+    ("Размер кВВ %", "ppvz_kvw_prc_base"),
+    ("Размер кВВ без НДС % Базовый", "ppvz_kvw_prc_base"),
+    ("Итоговый кВВ без НДС %", "ppvz_kvw_prc"),
+    ("Вознаграждение с продаж до вычета услуг поверенного без НДС", "ppvz_sales_commission"),
+    ("Возмещение за выдачу и возврат товаров на ПВЗ", "ppvz_reward"),
+    ("Эквайринг / Комиссии за организацию платежей", "acquiring_fee"),
+    ("Размер комиссии за эквайринг / Комиссии за организацию платежей %", "acquiring_percent"),
+    ("Тип платежа за Эквайринг / Комиссии за организацию платежей", "payment_processing"),
+    ("Вознаграждение Вайлдберриз (ВВ) без НДС", "ppvz_vw"),
+    ("НДС с Вознаграждения Вайлдберриз", "ppvz_vw_nds"),
+    ("К перечислению Продавцу за реализованный Товар", "ppvz_for_pay"),
+    ("Количество доставок", "delivery_amount"),
+    ("Количество возврата", "return_amount"),
+    ("Услуги по доставке товара покупателю", "delivery_rub"),
+    ("Дата начала действия фиксации", "fix_tariff_date_from"),
+    ("Дата конца действия фиксации", "fix_tariff_date_to"),
+    ("Признак услуги платной доставки", None),
+    ("Общая сумма штрафов", "penalty"),
+    ("Корректировка Вознаграждения Вайлдберриз (ВВ)", "additional_payment"),
+    ("Виды логистики, штрафов и корректировок ВВ", "bonus_type_name"),
+    ("Стикер МП", "sticker_id"),
+    ("Наименование банка-эквайера", "acquiring_bank"),
+    ("Номер офиса", "ppvz_office_id"),
+    ("Наименование офиса доставки", "ppvz_office_name"),
+    ("ИНН партнера", "ppvz_inn"),
+    ("Партнер", "ppvz_supplier_name"),
+    ("Склад", "office_name"),
+    ("Страна", "site_country"),
+    ("Тип коробов", "gi_box_type_name"),
+    ("Номер таможенной декларации", "declaration_number"),
+    ("Номер сборочного задания", "assembly_id"),
+    ("Код маркировки", "kiz"),
+    ("ШК", "shk_id"),
+    ("Srid", "srid"),
+    ("Возмещение издержек по перевозке / по складским операциям с товаром", "rebill_logistic_cost"),
+    ("Организатор перевозки", "rebill_logistic_org"),
+    ("Хранение", "storage_fee"),
+    ("Удержания", "deduction"),
+    ("Операции на приемке", "acceptance"),
+    ("Фиксированный коэффициент склада по поставке", "dlv_prc"),
+]
+REPORT_HEADERS = [title for title, field in REPORT_COLUMNS]
+_REPORT_FIELDS = [field for title, field in REPORT_COLUMNS]
+_NUMBER_IDX = REPORT_HEADERS.index("№")
+_ARTICLE_IDX = REPORT_HEADERS.index("Артикул")
+_NAME_IDX = REPORT_HEADERS.index("Название")
+_PAID_DELIVERY_IDX = REPORT_HEADERS.index("Признак услуги платной доставки")
+
+
+def parse_report_detail(data: list[dict], product_names: dict, start: int = 1) -> ReportTable:
+    table = ReportTable(REPORT_HEADERS)
+    rows = table.rows
+    for i, row in enumerate(data, start=start):
+        get = row.get
+        nm_id = int(get("nm_id"))
+        values = [get(field) for field in _REPORT_FIELDS]
+        values[_NUMBER_IDX] = i
+        values[_ARTICLE_IDX] = str(nm_id)
+        values[_NAME_IDX] = product_names.get(nm_id, "")
+        values[_PAID_DELIVERY_IDX] = (get("delivery_amount") or 0) > 0
+        rows.append(tuple(values))
+    return table
+
+
+def _get_report_url(date_from: datetime, date_to: datetime, rrdid: int) -> str:
     date_from_str = date_from.strftime("%Y-%m-%d")
     date_to_str = date_to.strftime("%Y-%m-%d")
+    return (f"{WB_REPORT_URL}?dateFrom={date_from_str}&dateTo={date_to_str}"
+            f"&limit={FIN_REPORT_PAGE_LIMIT}&rrdid={rrdid}")
+
+
+def _check_report_page(rows: list[dict], rrdid: int) -> bool:
+    # Returns True if there are more pages after this one
+    if rows is None:
+        if rrdid == 0:
+            logging.error("Empty response from WB API")
+            return False
+        raise IncompleteDataExc(f"Report page after rrdid={rrdid} is not loaded")
+    return len(rows) >= FIN_REPORT_PAGE_LIMIT
 
-    url = f"{WB_REPORT_URL}?dateFrom={date_from_str}&dateTo={date_to_str}"
+
+def iter_report_pages(token: str, date_from: datetime, date_to: datetime) -> Iterator[list[dict]]:
+    # Follows the rrdid cursor, so only one page of raw rows is kept in memory
     headers = utils.get_auth_header(token)
+    rrdid = 0
+    while True:
+        url = _get_report_url(date_from, date_to, rrdid)
+        rows = utils.api_get(
+            url, headers, FIN_REPORT_ATTEMPTS, FIN_REPORT_WAIT_TIME)
+        has_next = _check_report_page(rows, rrdid)
+        if rows:
+            yield rows
+        if not has_next:
+            break
+        rrdid = rows[-1].get("rrd_id")
+
+
+async def iter_report_pages_async(token: str, date_from: datetime, date_to: datetime) -> AsyncIterator[list[dict]]:
+    headers = utils.get_auth_header(token)
+    rrdid = 0
+    while True:
+        url = _get_report_url(date_from, date_to, rrdid)
+        rows = await async_utils.api_get(
+            url, headers, FIN_REPORT_ATTEMPTS, FIN_REPORT_WAIT_TIME)
+        has_next = _check_report_page(rows, rrdid)
+        if rows:
+            yield rows
+        if not has_next:
+            break
+        rrdid = rows[-1].get("rrd_id")
+
+
+def iter_report_detail(token: str, date_from: datetime, date_to: datetime) -> Iterator[ReportTable]:
+    product_names = None
+    row_number = 1
+    for rows in iter_report_pages(token, date_from, date_to):
+        if product_names is None:
+            product_names = get_product_names(token) or {}
+        batch = parse_report_detail(rows, product_names, row_number)
+        row_number += len(batch)
+        yield batch
+
+
+async def iter_report_detail_async(token: str, date_from: datetime, date_to: datetime) -> AsyncIterator[ReportTable]:
+    product_names = None
+    row_number = 1
+    async for rows in iter_report_pages_async(token, date_from, date_to):
+        if product_names is None:
+            product_names = await get_product_names_async(token) or {}
+        batch = parse_report_detail(rows, product_names, row_number)
+        row_number += len(batch)
+        yield batch
+
+
+def get_report_by_period(token: str, date_from: datetime, date_to: datetime) -> ReportTable:
+    report = ReportTable(REPORT_HEADERS)
+    for batch in iter_report_detail(token, date_from, date_to):
+        report.extend(batch)
+    return report
+
+
+async def get_report_by_period_async(token: str, date_from: datetime, date_to: datetime) -> ReportTable:
+    report = ReportTable(REPORT_HEADERS)
+    async for batch in iter_report_detail_async(token, date_from, date_to):
+        report.extend(batch)
+    return report
+
 
-    response = utils.api_get(
-        url, headers, FIN_REPORT_ATTEMPTS, FIN_REPORT_WAIT_TIME)
-    if not response:
-        logging.error("Empty response from WB API")
-        return []
-
-    product_names = get_product_names(token) or {}
-    return parse_report_detail(response, product_names)
-
-
-def write_finance_report(spreadsheet_id: str, token: str, sheet_name: str, period: WbPeriod):
-    report_entries = get_report_by_period(
-        token, period.start, period.end)
-    range_ = f"{sheet_name}!{FIN_REPORT_RANGE}"
-    # with open("output.csv", "w") as file:
-    #     headers = list(report_entries[0].keys())
-    #     values = [headers] + [list(row.values()) for row in report_entries]
-    #     for row in values:
-    #         file.write(";".join([str(i) for i in row]) + "\n")
-    utils.write_entries_to_google(spreadsheet_id, range_, report_entries)
+def write_finance_report(spreadsheet_id: str, token: str, sheet_name: str, period: WbPeriod,
+                         on_progress: Optional[Callable[[int, int], None]] = None):
+    # Not coalesced: every caller has its own progress callback, fin_report_jobs dedupes runs
+    batches = iter_report_detail(token, period.start, period.end)
+    utils.write_tables_to_google(
+        spreadsheet_id, sheet_name, FIN_REPORT_RANGE, batches, on_progress=on_progress)
     logging.info("Finish loading fin report")
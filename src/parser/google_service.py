@@ -0,0 +1,97 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from .parsers_config import creds_path, scope, SOCKET_WAIT_SEC, SHEETS_POOL_SIZE
+
+
+def _load_credentials():
+    from google.oauth2 import service_account
+
+    return service_account.Credentials.from_service_account_file(
+        creds_path, scopes=scope)
+
+
+def _build_service(credentials):
+    # Google client libraries are imported here, so importing the parser stays cheap
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build
+
+    # The timeout belongs to our client only, not to every socket of the process
+    http = google_auth_httplib2.AuthorizedHttp(
+        credentials, http=httplib2.Http(timeout=SOCKET_WAIT_SEC))
+    return build("sheets", "v4", http=http,
+                 static_discovery=True, cache_discovery=False)
+
+
+class SheetsServicePool:
+    # httplib2.Http is not thread-safe, so every thread checks out its own client
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = []
+        self._created = 0
+        self._credentials = None
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        with self._cond:
+            self.checkouts += 1
+            if not self._idle and self._created >= self.size:
+                self.waits += 1
+                started_at = time.monotonic()
+                # a failed build frees its slot, then the waiter builds a client itself
+                while not self._idle and self._created >= self.size:
+                    self._cond.wait()
+                self.wait_time += time.monotonic() - started_at
+            if self._idle:
+                return self._idle.pop()
+
+            if self._credentials is None:
+                self._credentials = _load_credentials()
+            credentials = self._credentials
+            self._created += 1
+
+        try:
+            return _build_service(credentials)
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, service):
+        with self._cond:
+            self._idle.append(service)
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "in_use": self._created - len(self._idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time_sec": round(self.wait_time, 3),
+            }
+
+
+_pool = SheetsServicePool(SHEETS_POOL_SIZE)
+
+
+@contextmanager
+def sheets_service():
+    service = _pool.acquire()
+    try:
+        yield service
+    finally:
+        _pool.release(service)
+
+
+def get_pool_stats() -> dict:
+    return _pool.stats()
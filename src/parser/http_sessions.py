@@ -0,0 +1,37 @@
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+from .parsers_config import HTTP_POOL_MAXSIZE, HTTP_POOL_SIZES
+
+# One keep-alive session per WB host, shared by the API handlers and scheduler jobs
+_sessions: dict[str, requests.Session] = {}
+_lock = threading.Lock()
+
+
+def _create_session(host: str) -> requests.Session:
+    pool_size = HTTP_POOL_SIZES.get(host, HTTP_POOL_MAXSIZE)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _create_session(host)
+            _sessions[host] = session
+        return session
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
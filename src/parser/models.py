@@ -1,4 +1,5 @@
 from datetime import date
+from enum import Enum
 from typing import Optional
 from pydantic import BaseModel
 
@@ -13,6 +14,10 @@ class WbPeriod(BaseModel):
         }
         return res
 
+class ReportFormat(str, Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+
 class AdvancedPeriodBody(BaseModel):
     selected: WbPeriod
     past: Optional[WbPeriod] = None
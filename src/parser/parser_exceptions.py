@@ -3,3 +3,9 @@ class UnathorizedExc(Exception):
 
 class InvalidBodyExc(Exception):
     pass
+
+class IncompleteDataExc(Exception):
+    pass
+
+class SheetsWriteExc(Exception):
+    pass
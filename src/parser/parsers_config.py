@@ -1,24 +1,36 @@
 import os
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
-import socket
 
 # PORT = 8000
 
 REQUEST_ATTEMPT_COUNT = 3
 REQUEST_WAIT_SEC = 5
 
+# keep-alive connections kept per WB host
+HTTP_POOL_MAXSIZE = 10
+HTTP_POOL_SIZES = {
+    "seller-analytics-api.wildberries.ru": 20,
+}
+
 #____COMMON_DATA___
 SOCKET_WAIT_SEC = 500
+SHEETS_POOL_SIZE = 8
 CARDS_LIST_URL = "https://content-api.wildberries.ru/content/v2/get/cards/list"
 CARDS_WAIT_TIME = 15
 
 # ____SALES_STATS___
 SALES_STATS_URL = "https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products"
 SALES_URL = "https://statistics-api.wildberries.ru/api/v1/supplier/sales"
+ORDERS_URL = "https://statistics-api.wildberries.ru/api/v1/supplier/orders"
+ORDERS_PAGE_SIZE = 80000
+ORDERS_MAX_PAGES = 10
+ORDERS_WAIT_TIME = 60
+# last days are fetched again on every run to catch late corrections
+ORDERS_RECHECK_DAYS = 2
 SALES_PERIOD_DAYS = 30
 DIFF_DAYS_COUNT = 10
 SALES_STATS_SHEET_NAME = "Продажи 10 дней"
+PERIOD_SALES_MAX_WORKERS = 4
+PERIOD_SALES_WORKERS_PER_TOKEN = 1
 
 # ____VORONKA_STATS____
 VORONKA_URL = "https://seller-analytics-api.wildberries.ru/api/analytics/v3/sales-funnel/products"
@@ -40,11 +52,56 @@ PROFITABILITY_SHEET_NAME = "Рентабельность"
 TOKEN_SHEET_NAME = "Токен"
 TOKEN_RANGE = "A1:A1"
 
+SHEETS_CACHE_TTL_SEC = 600
+SHEETS_CACHE_MAX_SIZE = 256
+
+# one values().batchUpdate request carries at most this much data
+SHEETS_CHUNK_MAX_ROWS = 5000
+SHEETS_CHUNK_MAX_BYTES = 2_000_000
+SHEETS_WRITE_ATTEMPTS = 3
+# waits between attempts double from SHEETS_WRITE_WAIT_SEC up to SHEETS_WRITE_MAX_WAIT_SEC
+SHEETS_WRITE_WAIT_SEC = 5
+SHEETS_WRITE_MAX_WAIT_SEC = 30
+# after the attempts above run out the writer waits and goes on from the failed chunk,
+# the wait goes on with the same schedule: 5, 10 | 20 | 5, 10 at most with the defaults
+SHEETS_RESUME_ATTEMPTS = 1
+# after this the sheet is read back instead of trusting the local snapshot
+SHEETS_SNAPSHOT_MAX_AGE_DAYS = 7
+
 # ____FINANCE_REPORT____
 WB_REPORT_URL = "https://statistics-api.wildberries.ru/api/v5/supplier/reportDetailByPeriod"
 FIN_REPORT_ATTEMPTS = 2
 FIN_REPORT_WAIT_TIME = 30
 FIN_REPORT_RANGE = "E:BP"
+FIN_REPORT_PAGE_LIMIT = 25000
+# /fin-report runs in the background, finished jobs are kept for polling
+FIN_REPORT_MAX_WORKERS = 2
+FIN_REPORT_JOB_KEEP_SEC = 24 * 60 * 60
+
+# ____REPORT_CACHE____
+# WB keeps revising the last days, a period counts as closed only after this
+REPORT_CACHE_SETTLE_DAYS = 3
+REPORT_CACHE_CLOSED_TTL_SEC = 24 * 60 * 60
+REPORT_CACHE_OPEN_TTL_SEC = 5 * 60
+REPORT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# keep closed periods in the sqlite db too, so they survive restarts
+REPORT_CACHE_USE_DISK = False
+
+# ____RATE_LIMITS____
+# WB counts limits per seller token: (interval between requests in sec, burst)
+RATE_LIMITS = {
+    VORONKA_URL: (20, 3),
+    SALES_STATS_URL: (20, 3),
+    SALES_URL: (60, 1),
+    ORDERS_URL: (60, 1),
+    REGION_SALE_URL: (10, 5),
+    CARDS_LIST_URL: (0.6, 5),
+    OFFICES_URL: (0.2, 20),
+    WB_WAREHOUSE_REMAINS_URL: (60, 1),
+    WB_WAREHOUSE_STATUS_URL: (5, 5),
+    WB_WAREHOUSE_DOWNLOAD_URL: (60, 1),
+    WB_REPORT_URL: (60, 1),
+}
 
 
 PARSER_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -56,7 +113,3 @@ token_path = os.path.join(security_folder, "table_id.txt")
 scope = ['https://spreadsheets.google.com/feeds',
          'https://www.googleapis.com/auth/drive']
 
-socket.setdefaulttimeout(SOCKET_WAIT_SEC) 
-credentials = service_account.Credentials.from_service_account_file(
-    creds_path, scopes=scope)
-service = build('sheets', 'v4', credentials=credentials)
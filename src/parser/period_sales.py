@@ -1,12 +1,14 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, date
 from pydantic import BaseModel
-import time
 from dataclasses import dataclass
 
 from . import parsers_config as pconfig
-from .parsers_config import service
 from . import utils
+from . import sheets_writer
+from .parser_exceptions import SheetsWriteExc
 from .data import db
 
 
@@ -15,6 +17,7 @@ class _RunConfig:
     SPREADSHEETS_ID: str
     DIFF_DAYS_COUNT: int
     IS_DEBUG: bool
+    IS_INCREMENTAL: bool = True
 
 
 class DayStats(BaseModel):
@@ -78,7 +81,6 @@ def get_period_stats(token: str, articles: list[int], start: datetime, end: date
         headers = utils.get_auth_header(token)
         result = utils.api_post(pconfig.SALES_STATS_URL,
                                 headers, body, req_wait_sec=20)
-        time.sleep(20)
 
         items = result.get("data", {}).get("items", [])
         if not items:
@@ -109,6 +111,94 @@ def get_period_sales(token: str, start_date: datetime) -> list[Sale]:
     return res
 
 
+def get_daily_orders(token: str, articles: list[int],
+                     start: datetime, end: datetime) -> dict[int, dict[date, int]]:
+    # One pass over the supplier orders feed gives orders of every day in the window
+    headers = utils.get_auth_header(token)
+    articles_set = set(articles)
+    start_day = start.date()
+    end_day = end.date()
+
+    orders: dict[int, dict[date, int]] = {a: {} for a in articles}
+    seen_srids = set()
+    date_from = start.strftime(r"%Y-%m-%d")
+    for i in range(pconfig.ORDERS_MAX_PAGES):
+        url = f"{pconfig.ORDERS_URL}?dateFrom={date_from}"
+        rows = utils.api_get(url, headers, 5, req_wait_sec=pconfig.ORDERS_WAIT_TIME)
+        if rows is None:
+            return None
+
+        for row in rows:
+            srid = row.get("srid")
+            if srid is not None:
+                if srid in seen_srids:
+                    continue
+                seen_srids.add(srid)
+
+            article = row.get("nmId")
+            if article not in articles_set:
+                continue
+            day = date.fromisoformat(row.get("date", "1970-01-01")[:10])
+            if day < start_day or day > end_day:
+                continue
+            article_orders = orders[article]
+            article_orders[day] = article_orders.get(day, 0) + 1
+
+        # The feed is ordered by lastChangeDate, next page starts from the last row
+        if len(rows) < pconfig.ORDERS_PAGE_SIZE:
+            break
+        date_from = rows[-1].get("lastChangeDate")
+
+    return orders
+
+
+def _get_daily_orders_by_days(token: str, articles: list[int],
+                              date_range: list[datetime]) -> dict[int, dict[date, int]]:
+    orders: dict[int, dict[date, int]] = {a: {} for a in articles}
+    for day in date_range:
+        day_stats = get_period_stats(token, articles, day, day)
+        if not day_stats:
+            continue
+
+        for item in day_stats:
+            article = item["nmID"]
+            metrics = item.get("metrics", {})
+            if not metrics or article not in orders:
+                continue
+            orders[article][day.date()] = metrics.get("ordersCount", 0)
+    return orders
+
+
+def _read_daily_orders(token: str, config: _RunConfig, articles: list[int],
+                       date_range: list[datetime]) -> dict[int, dict[date, int]]:
+    days = [d.date() for d in date_range]
+    fetch_days = days
+    if config.IS_INCREMENTAL:
+        synced = db.get_orders_synced_days(articles, days[0], days[-1])
+        recheck_from = days[-1] - timedelta(days=pconfig.ORDERS_RECHECK_DAYS - 1)
+        missing = [d for d in days if d not in synced or d >= recheck_from]
+        # The feed returns everything from the first missing day, so the tail is refreshed too
+        fetch_days = days[days.index(missing[0]):] if missing else []
+
+    if not fetch_days:
+        return db.get_daily_orders(articles, days[0], days[-1])
+
+    fetch_range = date_range[days.index(fetch_days[0]):]
+    fetched = get_daily_orders(token, articles, fetch_range[0], fetch_range[-1])
+    if fetched is not None:
+        db.save_daily_orders(fetched, fetch_days)
+        db.mark_orders_synced(articles, fetch_days)
+        return db.get_daily_orders(articles, days[0], days[-1])
+
+    # Failed days of the fallback can't be told apart, so its result is not stored
+    logging.warning("Orders feed is unavailable, reading orders day by day")
+    orders = db.get_daily_orders(articles, days[0], days[-1])
+    fetched = _get_daily_orders_by_days(token, articles, fetch_range)
+    for article, days_orders in fetched.items():
+        orders[article].update(days_orders)
+    return orders
+
+
 def read_sales_stats(token, config: _RunConfig,  articles_data: list[utils.ArticleData]) -> list[SalesStat]:
     articles = [i.article for i in articles_data]
     now = datetime.now()
@@ -146,32 +236,21 @@ def read_sales_stats(token, config: _RunConfig,  articles_data: list[utils.Artic
 
     date_range = [(start_date + timedelta(days=d))
                   for d in range(config.DIFF_DAYS_COUNT)]
-    article_daily_data = {a: {} for a in articles}
 
-    for day in date_range:
-        day_stats = get_period_stats(token, articles, day, day)
-        if not day_stats:
-            continue
-
-        for item in day_stats:
-            article = item["nmID"]
-            metrics = item.get("metrics", {})
-            if not metrics:
-                continue
-            orders = metrics.get("ordersCount", 0)
-            stocks = db.get_article_day_stocks(article, day.date()) or 0
-            if article in article_daily_data:
-                article_daily_data[article][day.date()] = (orders, stocks)
+    daily_orders = _read_daily_orders(token, config, articles, date_range)
+    stocks_matrix = db.get_stocks_matrix(articles, start_date.date(), config.DIFF_DAYS_COUNT)
 
     sales_stats = []
     for art_data in articles_data:
         article = art_data.article
         mdata = month_data.get(article, {})
+        article_orders = daily_orders.get(article, {})
+        article_stocks = stocks_matrix[article]
 
         days_stats = []
-        for day in date_range:
-            sales_count, stocks_count = article_daily_data.get(
-                article, {}).get(day.date(), (0, 0))
+        for i, day in enumerate(date_range):
+            sales_count = article_orders.get(day.date(), 0)
+            stocks_count = article_stocks[i] or 0
             days_stats.append(
                 DayStats(sales_count=sales_count, stocks_count=stocks_count))
 
@@ -251,55 +330,72 @@ def convert_sales_stats_to_table(rconfig: _RunConfig,
 
 
 def save_sales_stats_to_sheet(spreadsheet_id: str, data: list[list]):
-    sheet_name = pconfig.SALES_STATS_SHEET_NAME
-    range_name = f"{pconfig.SALES_STATS_SHEET_NAME}!A:ZZ"
-    body = {
-        "values": data
-    }
-
-    service.spreadsheets().values().clear(
-        spreadsheetId=spreadsheet_id,
-        range=sheet_name
-    ).execute()
-
-    tryings = 3
-    is_valid = False
-    for _ in range(tryings):
-        try:
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range=range_name,
-                valueInputOption="RAW",
-                body=body
-            ).execute()
-            is_valid = True
-            break
-        except:
-            pass
-    if not is_valid:
+    try:
+        sheets_writer.write_values_diff(
+            spreadsheet_id, pconfig.SALES_STATS_SHEET_NAME, data)
+    except SheetsWriteExc as err:
+        logging.exception(err)
         logging.error("Google sheets access error")
 
 
-def _period_sales_task_internal(rconfig: _RunConfig):
-    articles_data = utils.get_article_data(rconfig.SPREADSHEETS_ID)
-    if not articles_data:
-        logging.error("No profitability articles")
-        return
-    token = utils.get_wb_token(rconfig.SPREADSHEETS_ID)
-    if not token:
-        logging.error("No wb token")
-        return
+_token_slots: dict[str, threading.BoundedSemaphore] = {}
+_token_slots_lock = threading.Lock()
+
 
-    stats = read_sales_stats(token, rconfig, articles_data)
+def _get_token_slot(token: str) -> threading.BoundedSemaphore:
+    with _token_slots_lock:
+        slot = _token_slots.get(token)
+        if slot is None:
+            slot = threading.BoundedSemaphore(
+                pconfig.PERIOD_SALES_WORKERS_PER_TOKEN)
+            _token_slots[token] = slot
+        return slot
+
+
+def _period_sales_task_internal(rconfig: _RunConfig) -> bool:
+    spreadsheet_id = rconfig.SPREADSHEETS_ID
+    articles_data = utils.get_article_data(spreadsheet_id)
+    if not articles_data:
+        logging.error(f"No profitability articles, spreadsheet = {spreadsheet_id}")
+        return False
+    if not utils.get_wb_token(spreadsheet_id):
+        logging.error(f"No wb token, spreadsheet = {spreadsheet_id}")
+        return False
+
+    def read_stats(token: str) -> list[SalesStat]:
+        # Spreadsheets of one seller share the WB budget, so they run one by one
+        with _get_token_slot(token):
+            return read_sales_stats(token, rconfig, articles_data)
+
+    stats = utils.call_with_token(spreadsheet_id, read_stats)
     if not stats:
-        logging.error("Can't get stats")
-        return
+        logging.error(f"Can't get stats, spreadsheet = {spreadsheet_id}")
+        return False
     google_data = convert_sales_stats_to_table(rconfig, articles_data, stats)
-    save_sales_stats_to_sheet(rconfig.SPREADSHEETS_ID, google_data)
+    save_sales_stats_to_sheet(spreadsheet_id, google_data)
+    return True
 
 
 def period_sales_task():
     spreadsheets_ids = utils.get_spreadsheets_ids()
-    for spreadsheet_id in spreadsheets_ids:
-        rconfig = _RunConfig(spreadsheet_id, pconfig.DIFF_DAYS_COUNT, False)
-        _period_sales_task_internal(rconfig)
+    failed = []
+    with ThreadPoolExecutor(max_workers=pconfig.PERIOD_SALES_MAX_WORKERS) as executor:
+        futures = {}
+        for spreadsheet_id in spreadsheets_ids:
+            rconfig = _RunConfig(spreadsheet_id, pconfig.DIFF_DAYS_COUNT, False)
+            future = executor.submit(_period_sales_task_internal, rconfig)
+            futures[future] = spreadsheet_id
+
+        for future in as_completed(futures):
+            spreadsheet_id = futures[future]
+            try:
+                is_done = future.result()
+            except Exception as err:
+                logging.exception(err)
+                is_done = False
+            if not is_done:
+                failed.append(spreadsheet_id)
+
+    logging.info(f"Period sales task finished: "
+                 f"{len(spreadsheets_ids) - len(failed)}/{len(spreadsheets_ids)} done, failed = {failed}")
+    return failed
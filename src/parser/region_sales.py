@@ -1,10 +1,11 @@
-import time
-from typing import List
+from typing import AsyncIterator, List
 from pydantic import BaseModel
 
 from . import utils
+from . import async_utils
 from . import models
 from . import parsers_config as pconfig
+from .singleflight import coalesce_calls, coalesce_async_calls
 
 WAIT_TIME = 10
 
@@ -22,22 +23,13 @@ class RegionSale(BaseModel):
     sale_item_invoice_qty: int
 
 
-def get_region_sales(spreadsheets_id: str, period: models.WbPeriod) -> List[RegionSale]:
-    token = utils.get_wb_token(spreadsheets_id)
-    headers = utils.get_auth_header(token)
-
+def _get_report_url(period: models.WbPeriod) -> str:
     dates_postfix = f'dateFrom={period.start.strftime(r"%Y-%m-%d")}&dateTo={period.end.strftime(r"%Y-%m-%d")}'
-    report_url = f"{pconfig.REGION_SALE_URL}?{dates_postfix}"
-    result = utils.api_get(report_url, headers, req_wait_sec=WAIT_TIME)
-    if not result:
-        return []
+    return f"{pconfig.REGION_SALE_URL}?{dates_postfix}"
 
-    time.sleep(WAIT_TIME)
-    report = result.get("report", [])
-    if not report:
-        return []
 
-    article_data_list = utils.get_article_data(spreadsheets_id)
+def _parse_region_report(report: list[dict],
+                         article_data_list: list[utils.ArticleData]) -> List[RegionSale]:
     article_data_map = {
         a.article: a for a in article_data_list} if article_data_list else {}
 
@@ -62,3 +54,43 @@ def get_region_sales(spreadsheets_id: str, period: models.WbPeriod) -> List[Regi
         stats.append(stat)
 
     return stats
+
+
+@coalesce_calls
+def get_region_sales(spreadsheets_id: str, period: models.WbPeriod) -> List[RegionSale]:
+    result = utils.call_with_token(
+        spreadsheets_id,
+        lambda token: utils.api_get(_get_report_url(period), utils.get_auth_header(token),
+                                    req_wait_sec=WAIT_TIME))
+    if not result:
+        return []
+
+    report = result.get("report", [])
+    if not report:
+        return []
+
+    article_data_list = utils.get_article_data(spreadsheets_id)
+    return _parse_region_report(report, article_data_list)
+
+
+@coalesce_async_calls
+async def get_region_sales_async(spreadsheets_id: str, period: models.WbPeriod) -> List[RegionSale]:
+    result = await async_utils.call_with_token(
+        spreadsheets_id,
+        lambda token: async_utils.api_get(_get_report_url(period), utils.get_auth_header(token),
+                                          req_wait_sec=WAIT_TIME))
+    if not result:
+        return []
+
+    report = result.get("report", [])
+    if not report:
+        return []
+
+    article_data_list = await async_utils.get_article_data(spreadsheets_id)
+    return _parse_region_report(report, article_data_list)
+
+
+async def iter_region_sales_async(spreadsheets_id: str, period: models.WbPeriod) -> AsyncIterator[RegionSale]:
+    # WB returns the whole report in one response, rows are handed out for streaming
+    for sale in await get_region_sales_async(spreadsheets_id, period):
+        yield sale
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from datetime import date, timedelta
+from typing import AsyncIterator, Callable, NamedTuple, Optional, Union
+from cachetools import TLRUCache
+from pydantic import BaseModel
+
+from . import async_utils
+from . import models
+from . import utils
+from .data import db
+from .parser_exceptions import UnathorizedExc
+from .parsers_config import *
+
+
+class CachedReport(NamedTuple):
+    # rows serialized one per line, JSON never has raw newlines inside a row.
+    # A streamed report keeps the bytearray it was built in, it is not changed after that
+    body: Union[bytes, bytearray]
+    etag: str
+    expires_at: float
+    spreadsheets_id: str
+
+    def max_age(self) -> int:
+        return max(0, int(self.expires_at - time.time()))
+
+    def to_json_array(self) -> bytes:
+        return b"[" + self.body.replace(b"\n", b",") + b"]"
+
+    def to_ndjson(self) -> bytes:
+        return b"".join((self.body, b"\n")) if self.body else b""
+
+
+def is_period_closed(period: models.WbPeriod) -> bool:
+    return period.end < date.today() - timedelta(days=REPORT_CACHE_SETTLE_DAYS)
+
+
+def get_ttl(*periods: Optional[models.WbPeriod]) -> int:
+    if all(is_period_closed(period) for period in periods if period is not None):
+        return REPORT_CACHE_CLOSED_TTL_SEC
+    return REPORT_CACHE_OPEN_TTL_SEC
+
+
+def make_key(endpoint: str, spreadsheets_id: str, token_key: str, *periods: Optional[models.WbPeriod]) -> str:
+    # token_key separates the reports of different sellers shown in the same spreadsheet
+    parts = [endpoint, spreadsheets_id, token_key]
+    for period in periods:
+        if period is None:
+            parts.append("-")
+        else:
+            parts.append(f"{period.start.isoformat()}..{period.end.isoformat()}")
+    return "|".join(parts)
+
+
+class ReportCache:
+    # Serialized report bodies, LRU bounded by total size, every entry expires at its own time
+    def __init__(self, max_bytes: int, use_disk: bool = False):
+        self._cache = TLRUCache(maxsize=max_bytes,
+                                ttu=lambda _key, entry, _now: entry.expires_at,
+                                timer=time.time,
+                                getsizeof=lambda entry: len(entry.body))
+        self._lock = threading.Lock()
+        self._use_disk = use_disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _put(self, key: str, entry: CachedReport):
+        if len(entry.body) > self._cache.maxsize:
+            return
+        with self._lock:
+            self._cache[key] = entry
+
+    def get(self, key: str) -> Optional[CachedReport]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        if self._use_disk:
+            row = db.get_report_cache_entry(key)
+            if row is not None:
+                entry = CachedReport(row.body, row.etag, row.expires_at, row.spreadsheet_id)
+                self._put(key, entry)
+                with self._lock:
+                    self.disk_hits += 1
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, spreadsheets_id: str, body: Union[bytes, bytearray], ttl: int) -> CachedReport:
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        entry = CachedReport(body, etag, time.time() + ttl, spreadsheets_id)
+        self._put(key, entry)
+        # open periods change within minutes, not worth a disk write
+        if self._use_disk and ttl >= REPORT_CACHE_CLOSED_TTL_SEC:
+            try:
+                db.save_report_cache_entry(key, spreadsheets_id, body, etag, entry.expires_at)
+            except Exception as err:
+                logging.error(f"Can't save report cache entry: {err}")
+        return entry
+
+    def invalidate(self, spreadsheets_id: Optional[str] = None):
+        with self._lock:
+            if spreadsheets_id is None:
+                self._cache.clear()
+            else:
+                # a full scan, but only on an explicit invalidation
+                self._cache.expire()
+                keys = [key for key, entry in self._cache.items() if entry.spreadsheets_id == spreadsheets_id]
+                for key in keys:
+                    del self._cache[key]
+        if self._use_disk:
+            db.delete_report_cache_entries(spreadsheets_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "bytes": self._cache.currsize,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+report_cache = ReportCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_USE_DISK)
+
+
+class _SharedStream:
+    # Body of one report being computed, any number of readers can follow it.
+    # Rows are appended to the future cache body, so they are kept in memory only once
+    def __init__(self):
+        self.body = bytearray()
+        self.finished = False
+        self.error: Optional[Exception] = None
+        self.task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Condition()
+
+    async def publish(self, row: bytes = None, error: Exception = None, finished: bool = False):
+        async with self._updated:
+            if row is not None:
+                if self.body:
+                    self.body += b"\n"
+                self.body += row
+            self.error = error
+            self.finished = finished
+            self._updated.notify_all()
+
+    async def read(self) -> AsyncIterator[bytes]:
+        # Yields parts of the body that are ready, every part after the first one starts with a newline
+        offset = 0
+        while True:
+            async with self._updated:
+                await self._updated.wait_for(lambda: offset < len(self.body) or self.finished)
+                part = bytes(self.body[offset:])
+                finished = self.finished
+            if part:
+                yield part
+            offset += len(part)
+            if finished and offset == len(self.body):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+_streams: dict[str, _SharedStream] = {}
+
+
+def dump_row(row: BaseModel) -> bytes:
+    return row.__pydantic_serializer__.to_json(row)
+
+
+async def _produce(key: str, spreadsheets_id: str, periods: tuple,
+                   stream: _SharedStream, rows: AsyncIterator[BaseModel]):
+    try:
+        async for row in rows:
+            await stream.publish(dump_row(row))
+        ttl = get_ttl(*periods) if stream.body else REPORT_CACHE_OPEN_TTL_SEC
+        report_cache.set(key, spreadsheets_id, stream.body, ttl)
+        await stream.publish(finished=True)
+    except Exception as err:
+        logging.error(f"Report {key} failed: {err}")
+        await stream.publish(error=err, finished=True)
+    finally:
+        del _streams[key]
+
+
+async def open_report(endpoint: str, spreadsheets_id: str, periods: tuple,
+                make_rows: Callable[[], AsyncIterator[BaseModel]]) -> Union[CachedReport, AsyncIterator[bytes]]:
+    # Returns the cached report or parts of its body while they are computed.
+    # The computation runs apart from the reader, so it fills the cache even if the client goes away
+    token = await async_utils.get_wb_token(spreadsheets_id)
+    if not token:
+        raise UnathorizedExc(f"WB token of spreadsheet {spreadsheets_id} is not available")
+    key = make_key(endpoint, spreadsheets_id, utils.get_token_key(token), *periods)
+    cached = report_cache.get(key)
+    if cached is not None:
+        return cached
+
+    stream = _streams.get(key)
+    if stream is None:
+        stream = _SharedStream()
+        _streams[key] = stream
+        stream.task = asyncio.create_task(_produce(key, spreadsheets_id, periods, stream, make_rows()))
+    return stream.read()
@@ -0,0 +1,27 @@
+import csv
+from typing import TextIO
+
+
+class ReportTable:
+    # Column titles are declared once, every row is a plain tuple in the same order
+    def __init__(self, headers: list[str], rows: list[tuple] = None):
+        self.headers = headers
+        self.rows = rows if rows is not None else []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def extend(self, other: "ReportTable"):
+        self.rows += other.rows
+
+    def to_values(self, with_headers: bool = True) -> list:
+        # Matrix for Sheets values, rows are passed as is without copying
+        if with_headers:
+            return [self.headers] + self.rows
+        return self.rows
+
+    def write_csv(self, file: TextIO, with_headers: bool = True, delimiter: str = ";"):
+        writer = csv.writer(file, delimiter=delimiter)
+        if with_headers:
+            writer.writerow(self.headers)
+        writer.writerows(self.rows)
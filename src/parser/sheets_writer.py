@@ -0,0 +1,196 @@
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Iterable
+
+from .parsers_config import *
+from .parser_exceptions import SheetsWriteExc
+from .data import db
+from .google_service import sheets_service
+
+
+def get_write_wait_sec(attempt: int) -> int:
+    # One backoff schedule for the retries of a chunk and the resumes after them
+    return min(SHEETS_WRITE_WAIT_SEC * 2 ** attempt, SHEETS_WRITE_MAX_WAIT_SEC)
+
+
+def batch_update_values(spreadsheet_id: str, data: list[dict],
+                        attempts: int = SHEETS_WRITE_ATTEMPTS) -> int:
+    # data is a list of {"range": ..., "values": ...}, returns sent body size in bytes
+    body = {
+        "valueInputOption": "RAW",
+        "data": data
+    }
+    body_size = len(json.dumps(body, default=str))
+    for i in range(attempts):
+        try:
+            with sheets_service() as service:
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body=body
+                ).execute()
+            return body_size
+        except Exception as err:
+            logging.exception(err)
+            if i + 1 < attempts:
+                time.sleep(get_write_wait_sec(i))
+    raise SheetsWriteExc(f"Can't write {len(data)} ranges to {spreadsheet_id}")
+
+
+def _estimate_row_size(row: list) -> int:
+    return sum(len(str(value)) for value in row) + 4 * len(row)
+
+
+class ChunkedSheetsWriter:
+    # Writes rows one under another starting from start_row in size-bounded chunks.
+    # A chunk that failed with SheetsWriteExc stays queued, resume() sends it again
+    def __init__(self, spreadsheet_id: str, sheet_name: str, columns_range: str, start_row: int = 1,
+                 max_chunk_rows: int = SHEETS_CHUNK_MAX_ROWS,
+                 max_chunk_bytes: int = SHEETS_CHUNK_MAX_BYTES,
+                 attempts: int = SHEETS_WRITE_ATTEMPTS):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.first_col, self.last_col = columns_range.split(":")
+        self.max_chunk_rows = max_chunk_rows
+        self.max_chunk_bytes = max_chunk_bytes
+        self.attempts = attempts
+
+        self.next_row = start_row
+        self.done_chunks = 0
+        self.rows_written = 0
+        self.bytes_sent = 0
+        self.send_time = 0.0
+
+        self._pending: list[list] = []
+        self._pending_bytes = 0
+        # Full chunks waiting to be sent, the first one is retried on the next flush()
+        self._ready: list[list[list]] = []
+
+    def write_rows(self, rows: Iterable[list]):
+        for row in rows:
+            row_size = _estimate_row_size(row)
+            if self._pending and (len(self._pending) >= self.max_chunk_rows or
+                                  self._pending_bytes + row_size > self.max_chunk_bytes):
+                self._ready.append(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+            self._pending.append(row)
+            self._pending_bytes += row_size
+            if self._ready:
+                self._send_ready()
+
+    def resume(self):
+        self._send_ready()
+
+    def flush(self):
+        if self._pending:
+            self._ready.append(self._pending)
+            self._pending = []
+            self._pending_bytes = 0
+        self._send_ready()
+
+    def _send_ready(self):
+        while self._ready:
+            chunk = self._ready[0]
+            last_row = self.next_row + len(chunk) - 1
+            range_ = f"{self.sheet_name}!{self.first_col}{self.next_row}:{self.last_col}{last_row}"
+
+            started_at = time.monotonic()
+            sent = batch_update_values(self.spreadsheet_id,
+                                       [{"range": range_, "values": chunk}],
+                                       self.attempts)
+            self.send_time += time.monotonic() - started_at
+
+            self._ready.pop(0)
+            self.done_chunks += 1
+            self.rows_written += len(chunk)
+            self.bytes_sent += sent
+            self.next_row = last_row + 1
+
+    def log_stats(self):
+        send_time = self.send_time or 1e-9
+        logging.info(
+            f"Sheets write {self.spreadsheet_id}/{self.sheet_name}: {self.rows_written} rows, "
+            f"{self.bytes_sent} bytes in {self.done_chunks} chunks, "
+            f"{self.rows_written / send_time:.0f} rows/s, {self.bytes_sent / send_time:.0f} bytes/s")
+
+
+def _read_sheet_values(spreadsheet_id: str, sheet_name: str) -> list[list]:
+    try:
+        with sheets_service() as service:
+            resp = service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=sheet_name,
+                valueRenderOption="UNFORMATTED_VALUE"
+            ).execute()
+        return resp.get("values", [])
+    except Exception as err:
+        logging.exception(err)
+        return None
+
+
+def _trim_row(row: list) -> list:
+    end = len(row)
+    while end and row[end - 1] in ("", None):
+        end -= 1
+    return row[:end]
+
+
+def diff_row_blocks(old_values: list[list], new_values: list[list]) -> list[tuple[int, list[list]]]:
+    # Returns (first row index, rows) for every run of changed rows.
+    # Cells that had values and are now empty are overwritten with ""
+    blocks = []
+    block_start = None
+    block = []
+    for i in range(max(len(old_values), len(new_values))):
+        old_row = _trim_row(old_values[i]) if i < len(old_values) else []
+        new_row = _trim_row(new_values[i]) if i < len(new_values) else []
+        if old_row == new_row:
+            if block:
+                blocks.append((block_start, block))
+                block = []
+            continue
+        if not block:
+            block_start = i
+        block.append(new_row + [""] * (len(old_row) - len(new_row)))
+    if block:
+        blocks.append((block_start, block))
+    return blocks
+
+
+def write_values_diff(spreadsheet_id: str, sheet_name: str, values: list[list]) -> int:
+    # Sends only the rows that differ from the last written values, returns changed rows count.
+    # The last values come from the local snapshot or are read back from the sheet
+    new_values = json.loads(json.dumps(values, default=str))
+    max_age = timedelta(days=SHEETS_SNAPSHOT_MAX_AGE_DAYS)
+    old_values = db.get_sheet_snapshot(spreadsheet_id, sheet_name, max_age)
+    if old_values is None:
+        old_values = _read_sheet_values(spreadsheet_id, sheet_name)
+    if old_values is None:
+        raise SheetsWriteExc(f"Can't read current values of {spreadsheet_id}/{sheet_name}")
+
+    blocks = diff_row_blocks(old_values, new_values)
+    # If a batch fails after others went through the sheet matches neither values,
+    # without a snapshot the next run reads the sheet back
+    if blocks:
+        db.delete_sheet_snapshot(spreadsheet_id, sheet_name)
+    data = []
+    data_bytes = 0
+    bytes_sent = 0
+    for start, rows in blocks:
+        rows_bytes = sum(_estimate_row_size(row) for row in rows)
+        if data and data_bytes + rows_bytes > SHEETS_CHUNK_MAX_BYTES:
+            bytes_sent += batch_update_values(spreadsheet_id, data)
+            data = []
+            data_bytes = 0
+        data.append({"range": f"{sheet_name}!A{start + 1}", "values": rows})
+        data_bytes += rows_bytes
+    if data:
+        bytes_sent += batch_update_values(spreadsheet_id, data)
+
+    db.save_sheet_snapshot(spreadsheet_id, sheet_name, new_values)
+    changed_rows = sum(len(rows) for start, rows in blocks)
+    logging.info(f"Sheets diff write {spreadsheet_id}/{sheet_name}: "
+                 f"{changed_rows} of {len(new_values)} rows changed, {bytes_sent} bytes")
+    return changed_rows
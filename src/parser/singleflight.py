@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import threading
+from pydantic import BaseModel
+
+
+def _normalize(value) -> str:
+    if isinstance(value, BaseModel):
+        return value.model_dump_json()
+    return repr(value)
+
+
+def _make_key(fn, args, kwargs) -> str:
+    # Arguments are hashed, so WB tokens are not kept in the key
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    params = ", ".join(f"{name}={_normalize(value)}"
+                       for name, value in bound.arguments.items())
+    params_hash = hashlib.sha256(params.encode()).hexdigest()
+    return f"{fn.__module__}.{fn.__qualname__}:{params_hash}"
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Concurrent calls with the same key wait for the first one and share its result
+    def __init__(self):
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    async def do(self, key: str, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        # A disconnected caller must not cancel the computation for the others
+        return await asyncio.shield(task)
+
+
+_flight = SingleFlight()
+_async_flight = AsyncSingleFlight()
+
+
+def coalesce_calls(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = _make_key(fn, args, kwargs)
+        return _flight.do(key, fn, *args, **kwargs)
+    return wrapper
+
+
+def coalesce_async_calls(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        key = _make_key(fn, args, kwargs)
+        return await _async_flight.do(key, fn, *args, **kwargs)
+    return wrapper
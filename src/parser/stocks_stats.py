@@ -92,6 +92,11 @@ def get_stock_stats() -> List[StockStat]:
     if not stocks_data:
         return []
 
+    return parse_stocks_report(stocks_data, warehouse_map)
+
+
+def parse_stocks_report(stocks_data: List[Dict[str, Any]],
+                        warehouse_map: Dict[str, Dict[str, str]]) -> List[StockStat]:
     stats: List[StockStat] = []
 
     for item in stocks_data:
@@ -1,14 +1,23 @@
-import requests
 import time
 import json
+import re
+import hashlib
+import asyncio
+import threading
 from enum import Enum
-from typing import Union
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+from urllib.parse import urlsplit
 import logging
 from pydantic import BaseModel
 import os
 
 from .parsers_config import *
 from .parser_exceptions import *
+from . import http_sessions
+from .caches import CountingTTLCache
+from .sheets_writer import ChunkedSheetsWriter, get_write_wait_sec
+from .google_service import sheets_service
+from .report_table import ReportTable
 
 
 class RequestTypes(Enum):
@@ -23,11 +32,96 @@ class ArticleData(BaseModel):
     category: str
 
 
+class _TokenBucket:
+    def __init__(self, interval_sec: float, burst: int):
+        self.interval_sec = interval_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Takes one request from the budget, returns how long to wait before sending it.
+        # The budget may go negative, so concurrent callers queue up one interval apart.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated_at) / self.interval_sec)
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens * self.interval_sec
+
+
+class RateLimiter:
+    def __init__(self, limits: dict[str, tuple[float, int]]):
+        self._limits = limits
+        self._patterns = [
+            (re.compile(re.sub(r"\\\{\w+\\\}", "[^/]+", re.escape(url)) + "$"), url)
+            for url in limits if "{" in url
+        ]
+        self._buckets: dict[tuple[str, str], _TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _get_endpoint(self, url: str) -> str:
+        parts = urlsplit(url)
+        endpoint = f"{parts.scheme}://{parts.netloc}{parts.path}"
+        if endpoint in self._limits:
+            return endpoint
+        for pattern, template in self._patterns:
+            if pattern.match(endpoint):
+                return template
+        return None
+
+    def _get_bucket(self, url: str, token: str) -> _TokenBucket:
+        endpoint = self._get_endpoint(url)
+        if endpoint is None:
+            return None
+        key = (endpoint, token)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = _TokenBucket(*self._limits[endpoint])
+                self._buckets[key] = bucket
+            return bucket
+
+    def reserve(self, url: str, token: str) -> float:
+        bucket = self._get_bucket(url, token)
+        if bucket is None:
+            return 0
+        return bucket.reserve()
+
+    def wait(self, url: str, token: str):
+        wait_sec = self.reserve(url, token)
+        if wait_sec > 0:
+            logging.info(f"Rate limit wait {wait_sec:.1f}s, url = {url}")
+            time.sleep(wait_sec)
+
+    async def wait_async(self, url: str, token: str):
+        wait_sec = self.reserve(url, token)
+        if wait_sec > 0:
+            logging.info(f"Rate limit wait {wait_sec:.1f}s, url = {url}")
+            await asyncio.sleep(wait_sec)
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+# Spreadsheet id -> token / articles, saves a Sheets round trip per request
+_tokens_cache = CountingTTLCache(SHEETS_CACHE_MAX_SIZE, SHEETS_CACHE_TTL_SEC)
+_articles_cache = CountingTTLCache(SHEETS_CACHE_MAX_SIZE, SHEETS_CACHE_TTL_SEC)
+
+
 def get_auth_header(token: str) -> dict:
     header = {"Authorization": token}
     return header
 
 
+def get_token_key(token: str) -> str:
+    # Stable seller id for stored data, the token itself is never saved
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 def _send_request(url: str,
                   headers: dict,
                   attempts: int,
@@ -35,16 +129,21 @@ def _send_request(url: str,
                   mode: RequestTypes,
                   body: dict = None) -> Union[list[dict], dict]:
     resp = None
+    token = headers.get("Authorization", "")
     for i in range(attempts):
+        rate_limiter.wait(url, token)
         try:
+            session = http_sessions.get_session(url)
             if mode == RequestTypes.GET:
-                resp = requests.get(url, headers=headers,
-                                    timeout=on_error_wait_sec)
+                resp = session.get(url, headers=headers,
+                                   timeout=on_error_wait_sec)
             elif mode == RequestTypes.POST:
                 if body is None:
                     body = {}
-                resp = requests.post(url, headers=headers,
-                                     json=body, timeout=on_error_wait_sec)
+                resp = session.post(url, headers=headers,
+                                    json=body, timeout=on_error_wait_sec)
+            if resp.status_code == 204:
+                return []
             if resp.status_code != 200:
                 logging.error(
                     f"Api error (status={resp.status_code}) resp = {resp.text}, url = {url}")
@@ -79,48 +178,89 @@ def api_post(url: str, headers: dict, body: dict,
     return _send_request(url, headers, attempts, req_wait_sec, RequestTypes.POST, body)
 
 
-def read_google_table(spreadsheets_id, name, table_range) -> list[list[str]]:
+def read_google_ranges(spreadsheets_id: str, ranges: dict[str, str]) -> dict[str, list[list[str]]]:
+    # ranges maps any name to an A1 range, all of them are read with one values().batchGet
+    names = list(ranges.keys())
     tryings = 3
-    values = None
     for i in range(tryings):
         try:
-            values = service.spreadsheets().values().get(spreadsheetId=spreadsheets_id,
-                                                         range=f"{name}!{table_range}").execute()["values"]
-            break
+            with sheets_service() as service:
+                resp = service.spreadsheets().values().batchGet(
+                    spreadsheetId=spreadsheets_id,
+                    ranges=[ranges[name] for name in names]).execute()
+            value_ranges = resp.get("valueRanges", [])
+            return {name: value_range.get("values", [])
+                    for name, value_range in zip(names, value_ranges)}
         except Exception as err:
             logging.exception(err)
             continue
-    if not values:
-        return []
-    return values
+    return {}
+
+
+def _write_resuming(writer: ChunkedSheetsWriter, rows: Optional[Iterator[list]] = None):
+    # Writes rows (flushes when None). A failed chunk stays queued in the writer,
+    # after a pause sending goes on from it instead of loading the whole report again
+    for i in range(SHEETS_RESUME_ATTEMPTS + 1):
+        try:
+            if i:
+                writer.resume()
+            if rows is None:
+                writer.flush()
+            else:
+                writer.write_rows(rows)
+            return
+        except SheetsWriteExc as err:
+            if i == SHEETS_RESUME_ATTEMPTS:
+                raise
+            wait_sec = get_write_wait_sec(writer.attempts - 1 + i)
+            logging.warning(f"{err}, resuming from row {writer.next_row} in {wait_sec} sec")
+            time.sleep(wait_sec)
+
 
 def write_entries_to_google(spreadsheet_id: str, range_: str, data: list[dict], attempts=3):
     if len(data) == 0:
         return
-    
-    headers = list(data[0].keys())
-    values = [headers] + [list(entry.values()) for entry in data]
 
-    body = {
-        "values": values
-    }
-    for i in range(attempts):
-        try:
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range=range_,
-                valueInputOption="RAW",
-                body=body
-            ).execute()
-            break
-        except Exception as err:
-            logging.exception(err)
-            time.sleep(5)
+    sheet_name, columns_range = range_.rsplit("!", 1)
+    writer = ChunkedSheetsWriter(spreadsheet_id, sheet_name, columns_range, attempts=attempts)
+    _write_resuming(writer, iter([list(data[0].keys())]))
+    _write_resuming(writer, (list(entry.values()) for entry in data))
+    _write_resuming(writer)
+    writer.log_stats()
 
 
-def get_article_data(table_id: str) -> list[ArticleData]:
-    data = read_google_table(table_id, PROFITABILITY_SHEET_NAME,
-                      PROFITABILITY_ARTICLES_RANGE)
+def write_tables_to_google(spreadsheet_id: str, sheet_name: str, columns_range: str,
+                           tables: Iterable[ReportTable], start_row: int = 1, attempts=3,
+                           on_progress: Optional[Callable[[int, int], None]] = None) -> int:
+    # Writes tables one under another, headers go first when starting from the top.
+    # on_progress gets (report rows read, report rows written) after every table and the final flush.
+    # Returns the row after the last written one
+    writer = ChunkedSheetsWriter(spreadsheet_id, sheet_name, columns_range,
+                                 start_row, attempts=attempts)
+    with_headers = start_row == 1
+    header_rows = 0
+    rows_read = 0
+
+    def report_progress():
+        if on_progress:
+            on_progress(rows_read, max(writer.rows_written - header_rows, 0))
+
+    for table in tables:
+        if len(table) == 0:
+            continue
+        _write_resuming(writer, iter(table.to_values(with_headers)))
+        if with_headers:
+            header_rows = 1
+        with_headers = False
+        rows_read += len(table)
+        report_progress()
+    _write_resuming(writer)
+    report_progress()
+    writer.log_stats()
+    return writer.next_row
+
+
+def _parse_article_data(data: list[list[str]]) -> list[ArticleData]:
     if not data:
         return None
     res = []
@@ -142,8 +282,7 @@ def get_article_data(table_id: str) -> list[ArticleData]:
     return res
 
 
-def get_wb_token(table_id: str) -> str:
-    data = read_google_table(table_id, TOKEN_SHEET_NAME, TOKEN_RANGE)
+def _parse_wb_token(data: list[list[str]]) -> str:
     if not data:
         return None
     try:
@@ -152,6 +291,82 @@ def get_wb_token(table_id: str) -> str:
         return None
 
 
+def _load_spreadsheet_settings(table_id: str) -> tuple[str, list[ArticleData]]:
+    # Token and articles are usually needed together, so both come from one batchGet
+    token_range = f"{TOKEN_SHEET_NAME}!{TOKEN_RANGE}"
+    data = read_google_ranges(table_id, {
+        "token": token_range,
+        "articles": f"{PROFITABILITY_SHEET_NAME}!{PROFITABILITY_ARTICLES_RANGE}",
+    })
+    if not data:
+        # a missing Рентабельность sheet fails the whole batchGet, the token is read alone then
+        data = read_google_ranges(table_id, {"token": token_range})
+    token = _parse_wb_token(data.get("token"))
+    articles = _parse_article_data(data.get("articles"))
+    if token:
+        _tokens_cache.set(table_id, token)
+    if articles:
+        _articles_cache.set(table_id, articles)
+    return token, articles
+
+
+def get_article_data(table_id: str) -> list[ArticleData]:
+    cached = _articles_cache.get(table_id)
+    if cached is not None:
+        return cached
+    token, articles = _load_spreadsheet_settings(table_id)
+    return articles
+
+
+def get_wb_token(table_id: str) -> str:
+    cached = _tokens_cache.get(table_id)
+    if cached is not None:
+        return cached
+    token, articles = _load_spreadsheet_settings(table_id)
+    return token
+
+
+def call_with_token(table_id: str, fn: Callable[[str], Any]) -> Any:
+    # A 401 means the token in the sheet was replaced, the cached one is dropped
+    # and the call is made once more with the token read again
+    try:
+        return fn(get_wb_token(table_id))
+    except UnathorizedExc:
+        invalidate_spreadsheet_cache(table_id)
+        return fn(get_wb_token(table_id))
+
+
+def iter_with_token(table_id: str, make_iter: Callable[[str], Iterator]) -> Iterator:
+    # Same as call_with_token, the retry is only possible before anything was yielded
+    started = False
+    try:
+        for item in make_iter(get_wb_token(table_id)):
+            started = True
+            yield item
+        return
+    except UnathorizedExc:
+        invalidate_spreadsheet_cache(table_id)
+        if started:
+            raise
+    yield from make_iter(get_wb_token(table_id))
+
+
+def invalidate_spreadsheet_cache(table_id: str = None):
+    if table_id is None:
+        _tokens_cache.clear()
+        _articles_cache.clear()
+        return
+    _tokens_cache.invalidate(table_id)
+    _articles_cache.invalidate(table_id)
+
+
+def get_sheets_cache_stats() -> dict:
+    return {
+        "tokens": _tokens_cache.stats(),
+        "articles": _articles_cache.stats(),
+    }
+
+
 def get_spreadsheets_ids():
     ids_path = os.path.join(PARSER_DIR, "security_settings",
                             "voronka_spreadsheets_id.txt")
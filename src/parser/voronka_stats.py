@@ -1,12 +1,22 @@
-import time
-from typing import List, Optional
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional
 from pydantic import BaseModel
 
 from . import utils
+from . import async_utils
 from . import models
 from . import parsers_config as pconfig
+from .parser_exceptions import IncompleteDataExc
+from .singleflight import coalesce_calls, coalesce_async_calls
 
 WAIT_TIME = 20
+MAX_PAGES = 30
+PAGE_LIMIT = 1000
+PAGE_ATTEMPTS = 2
+# pages requested at once, the rate limiter spreads them over the token budget
+PAGES_PER_WAVE = pconfig.RATE_LIMITS[pconfig.VORONKA_URL][1]
 
 
 class VoronkaStat(BaseModel):
@@ -77,175 +87,276 @@ class VoronkaAdvancedStat(BaseModel):
     ctr_diff: float
 
 
-def get_voronka_data(wb_token: str,
-                     selected_period: models.WbPeriod, past_period: models.WbPeriod = None) -> list[dict]:
+def _build_voronka_body(selected_period: models.WbPeriod, past_period: models.WbPeriod, offset: int) -> dict:
+    body = {
+        "timezone": "Europe/Moscow",
+        "selectedPeriod": selected_period.to_dict(),
+        "orderBy": {
+            "field": "orderSum",
+            "mode": "asc"
+        },
+        "limit": PAGE_LIMIT,
+        "offset": offset
+    }
+    if past_period:
+        body["pastPeriod"] = past_period.to_dict()
+    return body
+
+
+def _page_cards(result) -> Optional[list[dict]]:
+    # None means the page is not loaded, 204 comes as an empty list
+    if result is None:
+        return None
+    if not result:
+        return []
+    return result.get("data", {}).get("products", [])
+
+
+def _iter_page_waves() -> Iterator[list[int]]:
+    # Offsets requested at once: the first page alone, most sellers fit into it
+    yield [0]
+    for first_page in range(1, MAX_PAGES, PAGES_PER_WAVE):
+        last_page = min(first_page + PAGES_PER_WAVE, MAX_PAGES)
+        yield [page * PAGE_LIMIT for page in range(first_page, last_page)]
+
+
+def _check_page(offset: int, cards: Optional[list[dict]]) -> list[dict]:
+    if cards is None:
+        raise IncompleteDataExc(f"Voronka page offset={offset} is not loaded")
+    return cards
+
+
+def _fetch_page(headers: dict, selected_period: models.WbPeriod,
+                past_period: models.WbPeriod, offset: int) -> Optional[list[dict]]:
+    body = _build_voronka_body(selected_period, past_period, offset)
+    for i in range(PAGE_ATTEMPTS):
+        cards = _page_cards(utils.api_post(pconfig.VORONKA_URL,
+                                           headers, body, req_wait_sec=WAIT_TIME))
+        if cards is not None:
+            return cards
+    return None
+
+
+async def _fetch_page_async(headers: dict, selected_period: models.WbPeriod,
+                            past_period: models.WbPeriod, offset: int) -> Optional[list[dict]]:
+    body = _build_voronka_body(selected_period, past_period, offset)
+    for i in range(PAGE_ATTEMPTS):
+        cards = _page_cards(await async_utils.api_post(pconfig.VORONKA_URL,
+                                                       headers, body, req_wait_sec=WAIT_TIME))
+        if cards is not None:
+            return cards
+    return None
+
+
+def iter_voronka_pages(wb_token: str, selected_period: models.WbPeriod,
+                       past_period: models.WbPeriod = None) -> Iterator[list[dict]]:
+    # Yields pages in offset order as soon as they and the pages before them are loaded
+    headers = utils.get_auth_header(wb_token)
+    with ThreadPoolExecutor(max_workers=PAGES_PER_WAVE) as executor:
+        for offsets in _iter_page_waves():
+            futures = [executor.submit(_fetch_page, headers, selected_period, past_period, offset)
+                       for offset in offsets]
+            for offset, future in zip(offsets, futures):
+                cards = _check_page(offset, future.result())
+                yield cards
+                if len(cards) < PAGE_LIMIT:
+                    return
+
+    logging.warning(f"Voronka stopped after {MAX_PAGES} pages")
+
+
+async def iter_voronka_pages_async(wb_token: str, selected_period: models.WbPeriod,
+                                   past_period: models.WbPeriod = None) -> AsyncIterator[list[dict]]:
     headers = utils.get_auth_header(wb_token)
-    all_cards = []
-
-    MAX_PAGES = 30
-    LIMIT = 1000
-    offset = 0
-    for i in range(MAX_PAGES):
-        body = {
-            "timezone": "Europe/Moscow",
-            "selectedPeriod": selected_period.to_dict(),
-            "orderBy": {
-                "field": "orderSum",
-                "mode": "asc"
-            },
-            "limit": LIMIT,
-            "offset": offset
-        }
-        if past_period:
-            body["pastPeriod"] = past_period.to_dict()
-
-        result = utils.api_post(pconfig.VORONKA_URL,
-                                headers, body, req_wait_sec=WAIT_TIME)
-        if not result:
-            return all_cards
-        time.sleep(WAIT_TIME)
-
-        data = result.get("data", {})
-        cards = data.get("products", [])
-        if not cards:
-            break
-        all_cards += cards
-
-        if len(cards) < LIMIT:
-            break
-        offset += LIMIT
-
-    return all_cards
+    for offsets in _iter_page_waves():
+        tasks = [asyncio.ensure_future(_fetch_page_async(headers, selected_period, past_period, offset))
+                 for offset in offsets]
+        try:
+            for offset, task in zip(offsets, tasks):
+                cards = _check_page(offset, await task)
+                yield cards
+                if len(cards) < PAGE_LIMIT:
+                    return
+        finally:
+            # the reader stopped early or a page failed
+            for task in tasks:
+                task.cancel()
+
+    logging.warning(f"Voronka stopped after {MAX_PAGES} pages")
 
 
+def get_voronka_data(wb_token: str,
+                     selected_period: models.WbPeriod, past_period: models.WbPeriod = None) -> list[dict]:
+    return [card for cards in iter_voronka_pages(wb_token, selected_period, past_period)
+            for card in cards]
+
+
+async def get_voronka_data_async(wb_token: str,
+                                 selected_period: models.WbPeriod,
+                                 past_period: models.WbPeriod = None) -> list[dict]:
+    return [card async for cards in iter_voronka_pages_async(wb_token, selected_period, past_period)
+            for card in cards]
+
+
+def _card_to_stat(card: dict) -> VoronkaStat:
+    product = card.get("product", {})
+    stat = card.get("statistic", {})
+    sel = stat.get("selected", {})
+    conv = sel.get("conversions", {})
+    stocks = product.get("stocks", {})
+
+    open_count = sel.get("openCount", 0)
+    cart_count = sel.get("cartCount", 0)
+
+    return VoronkaStat(
+        article=product.get("nmId", 0),
+        seller_article=product.get("vendorCode", ""),
+        brand=product.get("brandName", ""),
+        category=product.get("subjectName", ""),
+        stock_count=stocks.get("mp", 0) + stocks.get("wb", 0),
+        middle_in_day_sales=sel.get("avgOrdersCountPerDay", 0.0),
+        buyout_percent=conv.get("buyoutPercent", 0.0),
+        orders_count=sel.get("orderCount", 0),
+        orders_sum=sel.get("orderSum", 0.0),
+        lost_orders_count=sel.get("cancelCount", 0),
+        lost_orders_sum=sel.get("cancelSum", 0.0),
+        card_opens=open_count,
+        to_cart=cart_count,
+        ctr=(cart_count / open_count) if open_count else 0,
+        buyout_count=sel.get("buyoutCount", 0),
+        buyout_sum=sel.get("buyoutSum", 0.0),
+        returns_count=sel.get("cancelCount", 0),
+        returns_sum=sel.get("cancelSum", 0.0),
+    )
+
+
+def _card_to_advanced_stat(card: dict) -> VoronkaAdvancedStat:
+    product = card.get("product", {})
+    stat = card.get("statistic", {})
+
+    sel = stat.get("selected", {})
+    past_stat = stat.get("past", {})
+
+    sel_wb = sel.get("wbClub", {})
+    past_wb = past_stat.get("wbClub", {})
+
+    time_sel = sel.get("timeToReady", {})
+    time_past = past_stat.get("timeToReady", {})
+
+    open_count_1 = sel.get("openCount", 0)
+    open_count_2 = past_stat.get("openCount", 0)
+    to_cart_1 = sel.get("cartCount", 0)
+    to_cart_2 = past_stat.get("cartCount", 0)
+
+    ctr_1 = (to_cart_1 / open_count_1) if open_count_1 else 0
+    ctr_2 = (to_cart_2 / open_count_2) if open_count_2 else 0
+
+    order_count_1 = sel.get("orderCount", 0)
+    buyout_count_1 = sel.get("buyoutCount", 0)
+
+    order_count_2 = past_stat.get("orderCount", 0)
+    buyout_count_2 = past_stat.get("buyoutCount", 0)
+
+    buyout_percent_1 = buyout_count_1 / order_count_1 if order_count_1 != 0 else 0
+    buyout_percent_2 = buyout_count_2 / order_count_2 if order_count_2 != 0 else 0
+
+    return VoronkaAdvancedStat(
+        article=product.get("nmId", 0),
+        seller_article=product.get("vendorCode", ""),
+        brand=product.get("brandName", ""),
+        category=product.get("subjectName", ""),
+        stock_count=product.get("stocks", {}).get(
+            "mp", 0) + product.get("stocks", {}).get("wb", 0),
+
+        orders_count_1=order_count_1,
+        orders_sum_1=sel.get("orderSum", 0.0),
+        avg_orders_per_day_1=sel.get("avgOrdersCountPerDay", 0.0),
+        avg_price_1=sel.get("avgPrice", 0.0),
+        local_orders_1=sel.get("localizationPercent", 0),
+        buyout_percent_1=buyout_percent_1,
+        buyout_count_1=buyout_count_1,
+        returns_sum_1=sel.get("cancelSum", 0.0),
+        canceled_count_1=sel.get("cancelCount", 0),
+        delivery_time_days_1=time_sel.get("days", 0),
+        delivery_time_hours_1=time_sel.get("hours", 0),
+        delivery_time_mins_1=time_sel.get("mins", 0),
+        card_opens_1=open_count_1,
+        to_cart_1=to_cart_1,
+        ctr_1=ctr_1,
+
+        orders_count_2=order_count_2,
+        orders_sum_2=past_stat.get("orderSum", 0.0),
+        avg_orders_per_day_2=past_stat.get("avgOrdersCountPerDay", 0.0),
+        avg_price_2=past_stat.get("avgPrice", 0.0),
+        local_orders_2=past_stat.get("localizationPercent", 0),
+        buyout_percent_2=buyout_percent_2,
+        buyout_count_2=buyout_count_2,
+        returns_sum_2=past_stat.get("cancelSum", 0.0),
+        canceled_count_2=past_stat.get("cancelCount", 0),
+        delivery_time_days_2=time_past.get("days", 0),
+        delivery_time_hours_2=time_past.get("hours", 0),
+        delivery_time_mins_2=time_past.get("mins", 0),
+        card_opens_2=open_count_2,
+        to_cart_2=to_cart_2,
+        ctr_2=ctr_2,
+
+        orders_count_diff=order_count_1 - order_count_2,
+        orders_sum_diff=sel.get("orderSum", 0.0) -
+        past_stat.get("orderSum", 0.0),
+        buyout_count_diff=buyout_count_1 - buyout_count_2,
+        buyout_sum_diff=sel.get("buyoutSum", 0.0) -
+        past_stat.get("buyoutSum", 0.0),
+        ctr_diff=ctr_1 - ctr_2
+    )
+
+
+def iter_voronka_stats(spreadsheets_id: str, selected: models.WbPeriod) -> Iterator[VoronkaStat]:
+    pages = utils.iter_with_token(spreadsheets_id, lambda token: iter_voronka_pages(token, selected))
+    for cards in pages:
+        for card in cards:
+            yield _card_to_stat(card)
+
+
+async def iter_voronka_stats_async(spreadsheets_id: str, selected: models.WbPeriod) -> AsyncIterator[VoronkaStat]:
+    pages = async_utils.iter_with_token(spreadsheets_id,
+                                        lambda token: iter_voronka_pages_async(token, selected))
+    async for cards in pages:
+        for card in cards:
+            yield _card_to_stat(card)
+
+
+def iter_advanced_voronka_stats(spreadsheets_id: str, selected: models.WbPeriod,
+                                past: models.WbPeriod) -> Iterator[VoronkaAdvancedStat]:
+    pages = utils.iter_with_token(spreadsheets_id, lambda token: iter_voronka_pages(token, selected, past))
+    for cards in pages:
+        for card in cards:
+            yield _card_to_advanced_stat(card)
+
+
+async def iter_advanced_voronka_stats_async(spreadsheets_id: str, selected: models.WbPeriod,
+                                            past: models.WbPeriod) -> AsyncIterator[VoronkaAdvancedStat]:
+    pages = async_utils.iter_with_token(spreadsheets_id,
+                                        lambda token: iter_voronka_pages_async(token, selected, past))
+    async for cards in pages:
+        for card in cards:
+            yield _card_to_advanced_stat(card)
+
+
+@coalesce_calls
 def get_voronka_stats(spreadsheets_id: str, selected: models.WbPeriod) -> List[VoronkaStat]:
-    wb_token = utils.get_wb_token(spreadsheets_id)
-    stats: List[VoronkaStat] = []
-    cards = get_voronka_data(wb_token, selected_period=selected)
-    if not cards:
-        return []
+    return list(iter_voronka_stats(spreadsheets_id, selected))
+
 
-    for card in cards:
-        product = card.get("product", {})
-        stat = card.get("statistic", {})
-        sel = stat.get("selected", {})
-        conv = sel.get("conversions", {})
-        stocks = product.get("stocks", {})
-
-        open_count = sel.get("openCount", 0)
-        cart_count = sel.get("cartCount", 0)
-
-        stat_obj = VoronkaStat(
-            article=product.get("nmId", 0),
-            seller_article=product.get("vendorCode", ""),
-            brand=product.get("brandName", ""),
-            category=product.get("subjectName", ""),
-            stock_count=stocks.get("mp", 0) + stocks.get("wb", 0),
-            middle_in_day_sales=sel.get("avgOrdersCountPerDay", 0.0),
-            buyout_percent=conv.get("buyoutPercent", 0.0),
-            orders_count=sel.get("orderCount", 0),
-            orders_sum=sel.get("orderSum", 0.0),
-            lost_orders_count=sel.get("cancelCount", 0),
-            lost_orders_sum=sel.get("cancelSum", 0.0),
-            card_opens=open_count,
-            to_cart=cart_count,
-            ctr=(cart_count / open_count) if open_count else 0,
-            buyout_count=sel.get("buyoutCount", 0),
-            buyout_sum=sel.get("buyoutSum", 0.0),
-            returns_count=sel.get("cancelCount", 0),
-            returns_sum=sel.get("cancelSum", 0.0),
-        )
-        stats.append(stat_obj)
-
-    return stats
+@coalesce_async_calls
+async def get_voronka_stats_async(spreadsheets_id: str, selected: models.WbPeriod) -> List[VoronkaStat]:
+    return [stat async for stat in iter_voronka_stats_async(spreadsheets_id, selected)]
 
 
+@coalesce_calls
 def get_advanced_voronka_stats(spreadsheets_id: str, selected: models.WbPeriod, past: models.WbPeriod):
-    wb_token = utils.get_wb_token(spreadsheets_id)
-    cards = get_voronka_data(
-        wb_token, selected_period=selected, past_period=past)
-    if not cards:
-        return []
+    return list(iter_advanced_voronka_stats(spreadsheets_id, selected, past))
+
 
-    stats = []
-    for card in cards:
-        product = card.get("product", {})
-        stat = card.get("statistic", {})
-
-        sel = stat.get("selected", {})
-        past_stat = stat.get("past", {})
-
-        sel_wb = sel.get("wbClub", {})
-        past_wb = past_stat.get("wbClub", {})
-
-        time_sel = sel.get("timeToReady", {})
-        time_past = past_stat.get("timeToReady", {})
-
-        open_count_1 = sel.get("openCount", 0)
-        open_count_2 = past_stat.get("openCount", 0)
-        to_cart_1 = sel.get("cartCount", 0)
-        to_cart_2 = past_stat.get("cartCount", 0)
-
-        ctr_1 = (to_cart_1 / open_count_1) if open_count_1 else 0
-        ctr_2 = (to_cart_2 / open_count_2) if open_count_2 else 0
-
-        order_count_1 = sel.get("orderCount", 0)
-        buyout_count_1 = sel.get("buyoutCount", 0)
-
-        order_count_2 = past_stat.get("orderCount", 0)
-        buyout_count_2 = past_stat.get("buyoutCount", 0)
-
-        buyout_percent_1 = buyout_count_1 / order_count_1 if order_count_1 != 0 else 0
-        buyout_percent_2 = buyout_count_2 / order_count_2 if order_count_2 != 0 else 0
-
-        stat_obj = VoronkaAdvancedStat(
-            article=product.get("nmId", 0),
-            seller_article=product.get("vendorCode", ""),
-            brand=product.get("brandName", ""),
-            category=product.get("subjectName", ""),
-            stock_count=product.get("stocks", {}).get(
-                "mp", 0) + product.get("stocks", {}).get("wb", 0),
-
-            orders_count_1=order_count_1,
-            orders_sum_1=sel.get("orderSum", 0.0),
-            avg_orders_per_day_1=sel.get("avgOrdersCountPerDay", 0.0),
-            avg_price_1=sel.get("avgPrice", 0.0),
-            local_orders_1=sel.get("localizationPercent", 0),
-            buyout_percent_1=buyout_percent_1,
-            buyout_count_1=buyout_count_1,
-            returns_sum_1=sel.get("cancelSum", 0.0),
-            canceled_count_1=sel.get("cancelCount", 0),
-            delivery_time_days_1=time_sel.get("days", 0),
-            delivery_time_hours_1=time_sel.get("hours", 0),
-            delivery_time_mins_1=time_sel.get("mins", 0),
-            card_opens_1=open_count_1,
-            to_cart_1=to_cart_1,
-            ctr_1=ctr_1,
-
-            orders_count_2=order_count_2,
-            orders_sum_2=past_stat.get("orderSum", 0.0),
-            avg_orders_per_day_2=past_stat.get("avgOrdersCountPerDay", 0.0),
-            avg_price_2=past_stat.get("avgPrice", 0.0),
-            local_orders_2=past_stat.get("localizationPercent", 0),
-            buyout_percent_2=buyout_percent_2,
-            buyout_count_2=buyout_count_2,
-            returns_sum_2=past_stat.get("cancelSum", 0.0),
-            canceled_count_2=past_stat.get("cancelCount", 0),
-            delivery_time_days_2=time_past.get("days", 0),
-            delivery_time_hours_2=time_past.get("hours", 0),
-            delivery_time_mins_2=time_past.get("mins", 0),
-            card_opens_2=open_count_2,
-            to_cart_2=to_cart_2,
-            ctr_2=ctr_2,
-
-            orders_count_diff=order_count_1 - order_count_2,
-            orders_sum_diff=sel.get("orderSum", 0.0) -
-            past_stat.get("orderSum", 0.0),
-            buyout_count_diff=buyout_count_1 - buyout_count_2,
-            buyout_sum_diff=sel.get("buyoutSum", 0.0) -
-            past_stat.get("buyoutSum", 0.0),
-            ctr_diff=ctr_1 - ctr_2
-        )
-        stats.append(stat_obj)
-
-    return stats
+@coalesce_async_calls
+async def get_advanced_voronka_stats_async(spreadsheets_id: str, selected: models.WbPeriod, past: models.WbPeriod):
+    return [stat async for stat in iter_advanced_voronka_stats_async(spreadsheets_id, selected, past)]
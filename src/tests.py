@@ -1,8 +1,12 @@
+import threading
+import time
 from datetime import date, datetime, timedelta
 
 from parser import period_sales, region_sales, voronka_stats, finance_report
 from parser import utils, models
 from parser.data import db
+from parser.singleflight import coalesce_calls
+from parser import report_cache
 
 table_id = utils.get_spreadsheets_ids()[0]
 
@@ -109,14 +113,14 @@ def finance_report_test() -> bool:
     start_date = end_date - timedelta(days=7)
     period = models.WbPeriod(start=start_date, end=end_date)
 
-    report_rows = finance_report.get_report_by_period(token,
-                                                      period.start,
-                                                      period.end)
-    if not report_rows:
+    report = finance_report.get_report_by_period(token,
+                                                 period.start,
+                                                 period.end)
+    if not report:
         print("Finance report test failed: no data returned")
         return False
 
-    sample = report_rows[0]
+    sample = dict(zip(report.headers, report.rows[0]))
     required_keys = [
         "№", "Номер поставки", "Предмет", "Код номенклатуры", "Бренд",
         "Артикул поставщика", "Дата заказа покупателем", "Дата продажи",
@@ -136,6 +140,8 @@ def finance_report_test() -> bool:
 
 
 def db_tests() -> bool:
+    # row counts below are checked against an empty table
+    db.delete_test_db()
     db.init_test_db()
     today = date.today()
 
@@ -149,13 +155,124 @@ def db_tests() -> bool:
         print("DB test failed: update existing")
         return False
 
-    db.save_daily_stocks({1: 5, 2: 7, 3: 9}, today)
+    if db.save_daily_stocks({1: 5, 2: 7, 3: 9}, today) != (3, 0):
+        print("DB test failed: inserted rows count")
+        return False
+    if db.save_daily_stocks({1: 5, 2: 7, 4: 1}, today) != (1, 2):
+        print("DB test failed: updated rows count")
+        return False
     all_stocks = db.get_day_stocks(today)
     expected = {1: 5, 2: 7, 3: 9}
     if not all(all_stocks.get(k) == v for k, v in expected.items()):
         print(f"DB test failed: multiple articles (got {all_stocks})")
         return False
 
+    yesterday = today - timedelta(days=1)
+    db.save_daily_stocks({1: 4}, yesterday)
+    matrix = db.get_stocks_matrix([1, 2, 5], yesterday, 2)
+    if matrix != {1: [4, 5], 2: [None, 7], 5: [None, None]}:
+        print(f"DB test failed: stocks matrix (got {matrix})")
+        return False
+
+    return True
+
+
+def daily_orders_db_test() -> bool:
+    db.init_test_db()
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+
+    db.save_daily_orders({1: {yesterday: 3, today: 4}, 2: {today: 1}}, [yesterday, today])
+    orders = db.get_daily_orders([1, 2, 3], yesterday, today)
+    if orders != {1: {yesterday: 3, today: 4}, 2: {today: 1}, 3: {}}:
+        print(f"Daily orders test failed: save/get (got {orders})")
+        return False
+
+    db.save_daily_orders({1: {today: 2}, 2: {}}, [today])
+    orders = db.get_daily_orders([1, 2], yesterday, today)
+    if orders != {1: {yesterday: 3, today: 2}, 2: {}}:
+        print(f"Daily orders test failed: rewrite day (got {orders})")
+        return False
+
+    db.mark_orders_synced([1, 2], [yesterday, today])
+    db.mark_orders_synced([1], [today])
+    if db.get_orders_synced_days([1, 2], yesterday, today) != {yesterday, today}:
+        print("Daily orders test failed: synced days")
+        return False
+    if db.get_orders_synced_days([1, 2, 3], yesterday, today):
+        print("Daily orders test failed: new article synced")
+        return False
+
+    return True
+
+
+def card_titles_db_test() -> bool:
+    db.init_test_db()
+    seller_key = utils.get_token_key("test-token")
+
+    db.save_card_titles(seller_key, {1: "first", 2: "second"}, "2025-01-01T00:00:00Z", 2)
+    db.save_card_titles(seller_key, {2: "renamed"})
+    if db.get_card_titles(seller_key) != {1: "first", 2: "renamed"}:
+        print("Card titles test failed: save/get titles")
+        return False
+
+    if db.get_cards_cursor(seller_key) != ("2025-01-01T00:00:00Z", 2):
+        print("Card titles test failed: cursor")
+        return False
+
+    return True
+
+
+def singleflight_test() -> bool:
+    calls = []
+
+    @coalesce_calls
+    def slow_report(spreadsheets_id: str, period: models.WbPeriod):
+        calls.append(spreadsheets_id)
+        time.sleep(0.2)
+        return [spreadsheets_id]
+
+    period = models.WbPeriod(start=datetime(2025, 1, 1), end=datetime(2025, 1, 7))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow_report(table_id, period)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(calls) != 1 or results != [[table_id]] * 5:
+        print(f"Singleflight test failed: {len(calls)} upstream calls")
+        return False
+
+    return True
+
+
+def report_cache_test() -> bool:
+    today = date.today()
+    closed = models.WbPeriod(start=today - timedelta(days=30), end=today - timedelta(days=10))
+    current = models.WbPeriod(start=today - timedelta(days=7), end=today)
+    if report_cache.get_ttl(closed) <= report_cache.get_ttl(closed, current):
+        print("Report cache test failed: open period ttl")
+        return False
+
+    cache = report_cache.ReportCache(max_bytes=10)
+    key = report_cache.make_key("voronka-stats", table_id, utils.get_token_key("test-token"), closed)
+    entry = cache.set(key, table_id, b"[1,2]", report_cache.get_ttl(closed))
+    if cache.get(key) != entry:
+        print("Report cache test failed: get after set")
+        return False
+
+    cache.set("other", table_id, b"[3,4,5,6]", 60)
+    if cache.get(key) is not None:
+        print("Report cache test failed: size eviction")
+        return False
+
+    cache.invalidate(table_id)
+    if cache.stats()["size"] != 0:
+        print("Report cache test failed: invalidate")
+        return False
+
     return True
 
 
@@ -165,6 +282,10 @@ def run_tests():
         # articles_data_test,
         # period_sales_test,
         # db_tests,
+        # daily_orders_db_test,
+        # card_titles_db_test,
+        # singleflight_test,
+        # report_cache_test,
         voronka_stats_test,
         # region_sales_test
         # finance_report_test